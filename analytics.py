@@ -0,0 +1,171 @@
+"""
+Vectorized item analysis over the columnar answer store.
+
+All statistics work on whole (sheets x questions) arrays at once, so tens of
+thousands of sheets are analysed in milliseconds. A question counts as
+correct exactly when evaluate_results would count it: the marked option
+equals the single option in the key.
+
+It also aggregates evaluations.csv into fixed-size chart series for the
+reports page, so its payload does not grow with the number of evaluations.
+"""
+import numpy as np
+import pandas as pd
+
+from answer_store import load_matrix, OPTIONS, BLANK, MULTI_ANSWER, MISSING, NUM_ITEMS
+from omr_utils import SUBJECTS
+
+QUESTIONS_PER_SUBJECT = NUM_ITEMS // len(SUBJECTS)
+
+
+def correct_matrix(answers, keys):
+    """Boolean (sheets x questions) matrix of correct answers."""
+    scorable = (keys != BLANK) & (keys != MULTI_ANSWER) & (keys != MISSING)
+    return (answers == keys) & scorable
+
+
+def item_statistics(answers, keys):
+    """
+    Per-question statistics:
+    - difficulty: share of sheets that answered correctly (higher is easier)
+    - discrimination: correlation between the item and the rest of the score
+    - options: share of sheets that marked blank, A, B, C, D (5 x questions)
+    """
+    correct = correct_matrix(answers, keys).astype(np.float64)
+    n = correct.shape[0]
+    if n == 0:
+        empty = np.zeros(NUM_ITEMS)
+        return {"difficulty": empty, "discrimination": empty,
+                "options": np.zeros((len(OPTIONS) + 1, NUM_ITEMS))}
+
+    difficulty = correct.mean(axis=0)
+
+    # Corrected item-total correlation: the item itself is left out of the total
+    rest = correct.sum(axis=1, keepdims=True) - correct
+    item_dev = correct - difficulty
+    rest_dev = rest - rest.mean(axis=0)
+    numerator = (item_dev * rest_dev).sum(axis=0)
+    denominator = np.sqrt((item_dev ** 2).sum(axis=0) * (rest_dev ** 2).sum(axis=0))
+    discrimination = np.divide(numerator, denominator, out=np.zeros(NUM_ITEMS), where=denominator > 0)
+
+    codes = np.arange(len(OPTIONS) + 1, dtype=np.uint8)[:, None, None]
+    options = (answers[None, :, :] == codes).mean(axis=1)
+
+    return {"difficulty": difficulty, "discrimination": discrimination, "options": options}
+
+
+def score_distributions(answers, keys):
+    """Histogram of per-subject scores (0-20) and of total scores (0-100)."""
+    correct = correct_matrix(answers, keys)
+    subject_scores = correct.reshape(-1, len(SUBJECTS), QUESTIONS_PER_SUBJECT).sum(axis=2)
+    per_subject = {s: np.bincount(subject_scores[:, i], minlength=QUESTIONS_PER_SUBJECT + 1)
+                   for i, s in enumerate(SUBJECTS)}
+    total = np.bincount(correct.sum(axis=1), minlength=NUM_ITEMS + 1)
+    return {"subjects": per_subject, "total": total}
+
+
+def version_comparison(answers, keys, versions, version_names):
+    """Sheet count, mean and standard deviation of the total score per version."""
+    totals = correct_matrix(answers, keys).sum(axis=1).astype(np.float64)
+    minlength = len(version_names)
+    counts = np.bincount(versions, minlength=minlength)
+    sums = np.bincount(versions, weights=totals, minlength=minlength)
+    squares = np.bincount(versions, weights=totals ** 2, minlength=minlength)
+    means = np.divide(sums, counts, out=np.zeros(minlength), where=counts > 0)
+    variances = np.divide(squares, counts, out=np.zeros(minlength), where=counts > 0) - means ** 2
+    return [{"version": name, "sheets": int(counts[i]), "mean": round(float(means[i]), 2),
+             "std": round(float(np.sqrt(max(variances[i], 0.0))), 2)}
+            for i, name in enumerate(version_names)]
+
+
+def item_report(version=None):
+    """Loads the answer store and computes everything the item analysis page shows."""
+    data = load_matrix()
+    answers, keys, versions = data["answers"], data["keys"], data["versions"]
+    comparison = version_comparison(answers, keys, versions, data["version_names"])
+
+    if version:
+        if version in data["version_names"]:
+            selected = versions == data["version_names"].index(version)
+        else:
+            selected = np.zeros(len(versions), dtype=bool)
+        answers, keys = answers[selected], keys[selected]
+
+    stats = item_statistics(answers, keys)
+    items = []
+    for q in range(NUM_ITEMS):
+        subject_idx, number = divmod(q, QUESTIONS_PER_SUBJECT)
+        items.append({
+            "subject": SUBJECTS[subject_idx],
+            "question": number + 1,
+            "difficulty": round(float(stats["difficulty"][q]), 3),
+            "discrimination": round(float(stats["discrimination"][q]), 3),
+            "options": {label: round(float(stats["options"][i, q]), 3)
+                        for i, label in enumerate(["Blank"] + OPTIONS)},
+        })
+
+    distributions = score_distributions(answers, keys)
+    return {
+        "sheets": int(answers.shape[0]),
+        "items": items,
+        "subject_distributions": {s: h.tolist() for s, h in distributions["subjects"].items()},
+        "total_distribution": distributions["total"].tolist(),
+        "versions": comparison,
+    }
+
+
+# -------------------------
+# Reports page chart data
+# -------------------------
+POINT_BUDGET = 200
+SCORE_BINS = [(0, 5), (6, 10), (11, 15), (16, 20)]
+TIME_FREQUENCIES = ["h", "D", "W", "MS"]
+
+
+def time_series(df, budget=POINT_BUDGET):
+    """Sheet count and mean total score per time bin, using the finest of
+    hour/day/week/month that fits in the point budget."""
+    if "Date" not in df.columns or "Total Score" not in df.columns:
+        return {"labels": [], "count": [], "mean_total": [], "bin": None}
+    dates = pd.to_datetime(df["Date"], errors="coerce")
+    totals = pd.to_numeric(df["Total Score"], errors="coerce")
+    valid = dates.notna() & totals.notna()
+    if not valid.any():
+        return {"labels": [], "count": [], "mean_total": [], "bin": None}
+    series = pd.Series(totals[valid].values, index=dates[valid].values).sort_index()
+
+    for freq in TIME_FREQUENCIES:
+        grouped = series.resample(freq).agg(["count", "mean"])
+        grouped = grouped[grouped["count"] > 0]
+        if len(grouped) <= budget:
+            break
+    label_format = "%Y-%m-%d %H:00" if freq == "h" else "%Y-%m-%d"
+    return {
+        "labels": [ts.strftime(label_format) for ts in grouped.index],
+        "count": grouped["count"].astype(int).tolist(),
+        "mean_total": grouped["mean"].round(2).tolist(),
+        "bin": freq,
+    }
+
+
+def subject_histograms(df):
+    """Counts of each subject's scores in SCORE_BINS."""
+    labels = [f"{low}-{high}" for low, high in SCORE_BINS]
+    edges = [SCORE_BINS[0][0]] + [high + 1 for _, high in SCORE_BINS]
+    histograms = {}
+    for s in SUBJECTS:
+        scores = pd.to_numeric(df[s], errors="coerce").fillna(0).to_numpy() if s in df.columns else np.zeros(0)
+        # Scores outside the bins fall into the nearest one, as on the old client-side chart
+        scores = np.clip(scores, edges[0], edges[-1] - 1)
+        counts, _ = np.histogram(scores, bins=edges)
+        histograms[s] = {"labels": labels, "counts": counts.tolist()}
+    return histograms
+
+
+def chart_series(df, budget=POINT_BUDGET):
+    """Everything the reports page charts need, aggregated to a fixed size."""
+    return {
+        "sheets": int(len(df)),
+        "time": time_series(df, budget),
+        "subjects": subject_histograms(df),
+    }
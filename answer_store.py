@@ -0,0 +1,143 @@
+"""
+Columnar store of the raw per-question answers of every evaluation.
+
+evaluations.csv only keeps per-subject totals. Here every evaluation also
+appends one row of 100 answer codes (and the matching key codes) to
+fixed-size chunks of .npy files, so item analysis can run over all sheets
+without re-processing them:
+
+    uploads/answer_matrix/
+        manifest.json           row count and version names
+        store.lock              held while a row is appended
+        answers_00000.npy       (CHUNK_ROWS, NUM_ITEMS) uint8
+        keys_00000.npy          (CHUNK_ROWS, NUM_ITEMS) uint8
+        versions_00000.npy      (CHUNK_ROWS,) int16, index into manifest["versions"]
+
+Answer codes: 0 = blank, 1-4 = A-D. Key codes also use MULTI_ANSWER for
+questions with several accepted options and MISSING for questions the key
+does not cover.
+"""
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are then only safe from a single process
+    fcntl = None
+
+STORE_FOLDER = os.path.join("uploads", "answer_matrix")
+CHUNK_ROWS = 4096
+NUM_ITEMS = 100
+
+OPTIONS = ["A", "B", "C", "D"]
+BLANK = 0
+MULTI_ANSWER = 5
+MISSING = 255
+
+COLUMNS = {
+    "answers": (np.uint8, (NUM_ITEMS,)),
+    "keys": (np.uint8, (NUM_ITEMS,)),
+    "versions": (np.int16, ()),
+}
+
+
+def encode(value):
+    if isinstance(value, (list, tuple)):
+        return MULTI_ANSWER
+    value = str(value).strip().upper()
+    return OPTIONS.index(value) + 1 if value in OPTIONS else BLANK
+
+
+def encode_sheet(subjects, missing=BLANK):
+    """Flattens [[subject answers], ...] subject by subject into NUM_ITEMS codes."""
+    codes = [encode(v) for subject in subjects for v in subject][:NUM_ITEMS]
+    return np.array(codes + [missing] * (NUM_ITEMS - len(codes)), dtype=np.uint8)
+
+
+def read_manifest(folder=STORE_FOLDER):
+    path = os.path.join(folder, "manifest.json")
+    if not os.path.isfile(path):
+        return {"rows": 0, "versions": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, folder=STORE_FOLDER):
+    path = os.path.join(folder, "manifest.json")
+    fd, tmp_path = tempfile.mkstemp(prefix="manifest.", suffix=".tmp", dir=folder)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def chunk_path(folder, column, chunk):
+    return os.path.join(folder, f"{column}_{chunk:05d}.npy")
+
+
+@contextmanager
+def store_lock(folder=STORE_FOLDER):
+    """Exclusive lock on the store, shared by threads and processes (Flask, API, pipeline)."""
+    with open(os.path.join(folder, "store.lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def append_answers(answers, key, version, folder=STORE_FOLDER):
+    """Appends one evaluated sheet (5 x 20 answers and key) to the store."""
+    os.makedirs(folder, exist_ok=True)
+    # Reading the row count and writing the manifest must not interleave with another append
+    with store_lock(folder):
+        append_row(answers, key, version, folder)
+
+
+def append_row(answers, key, version, folder):
+    manifest = read_manifest(folder)
+    if version not in manifest["versions"]:
+        manifest["versions"].append(version)
+
+    row = manifest["rows"]
+    chunk, offset = divmod(row, CHUNK_ROWS)
+    values = {
+        "answers": encode_sheet(answers),
+        "keys": encode_sheet(key, missing=MISSING),
+        "versions": manifest["versions"].index(version),
+    }
+    for column, (dtype, shape) in COLUMNS.items():
+        path = chunk_path(folder, column, chunk)
+        if os.path.isfile(path):
+            data = np.load(path, mmap_mode="r+")
+        else:
+            data = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(CHUNK_ROWS,) + shape)
+        data[offset] = values[column]
+        data.flush()
+        del data
+
+    # The row only becomes visible once the manifest counts it
+    manifest["rows"] = row + 1
+    write_manifest(manifest, folder)
+
+
+def load_matrix(folder=STORE_FOLDER):
+    """
+    Loads all stored rows. Returns a dict with "answers" and "keys"
+    (rows x NUM_ITEMS uint8), "versions" (rows int16) and "version_names".
+    """
+    manifest = read_manifest(folder)
+    rows = manifest["rows"]
+    data = {"version_names": manifest["versions"]}
+    for column, (dtype, shape) in COLUMNS.items():
+        chunks = []
+        for chunk in range((rows + CHUNK_ROWS - 1) // CHUNK_ROWS):
+            chunks.append(np.load(chunk_path(folder, column, chunk), mmap_mode="r"))
+        data[column] = (np.concatenate(chunks)[:rows] if chunks
+                        else np.zeros((0,) + shape, dtype=dtype))
+    return data
@@ -0,0 +1,200 @@
+"""
+JSON scoring API for mobile capture clients.
+
+Clients POST the raw image bytes of one OMR sheet together with the answer
+key ID and get back the marked answers, per-subject scores and a confidence
+value. The CV work runs in a bounded process pool so the event loop stays
+free to accept uploads; when too many sheets are already queued the API
+answers 503 instead of letting the queue grow.
+
+Run with:
+    uvicorn api:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import cv2
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+
+from files import process_answer_key, ANSWER_FOLDER
+from omr_utils import evaluate_results, save_evaluation, SUBJECTS
+from s2 import process_image, process_image_multi
+
+# --- Configuration ---
+CV_WORKERS = int(os.environ.get("OMR_CV_WORKERS", os.cpu_count() or 1))
+MAX_PENDING = int(os.environ.get("OMR_MAX_PENDING", CV_WORKERS * 4))
+MAX_UPLOAD_BYTES = 15 * 1024 * 1024
+RETRY_AFTER_SECONDS = 2
+
+executor = None
+pending = 0
+save_lock = asyncio.Lock()
+key_cache = {}
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global executor
+    executor = ProcessPoolExecutor(max_workers=CV_WORKERS)
+    # The pool forks its workers on the first submit. Do that now, before
+    # asyncio.to_thread has started any threads whose locks a child could inherit
+    executor.submit(int).result()
+    yield
+    executor.shutdown(wait=True, cancel_futures=True)
+
+
+app = FastAPI(title="OMR Evaluator API", lifespan=lifespan)
+
+
+# --- CV workers (run in the process pool) ---
+def score_image_bytes(data):
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None, None
+    return process_image(image)
+
+
+def score_image_bytes_multi(data):
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return [], []
+    return process_image_multi(image)
+
+
+# --- Helpers ---
+def key_path_for(key_id):
+    # Only plain file names from the answer key folder are accepted
+    if not key_id or os.path.basename(key_id) != key_id:
+        raise HTTPException(status_code=400, detail="Invalid key_id.")
+    path = os.path.join(ANSWER_FOLDER, key_id)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Answer key '{key_id}' not found.")
+    return path
+
+
+async def load_key(path):
+    """Parses an answer key once and reuses it until the file changes."""
+    mtime = os.path.getmtime(path)
+    cached = key_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    key_answers = await asyncio.to_thread(process_answer_key, path)
+    key_cache[path] = (mtime, key_answers)
+    return key_answers
+
+
+def build_response(key_id, answers, confidence, result):
+    per_question = {SUBJECTS[i]: [round(c, 3) for c in confidence[i]] for i in range(len(SUBJECTS))}
+    all_values = [c for row in confidence for c in row]
+    return {
+        "key_id": key_id,
+        "date": result["date"],
+        "answers": {SUBJECTS[i]: answers[i] for i in range(len(SUBJECTS))},
+        "scores": {s: result["result"].get(s, 0) for s in SUBJECTS},
+        "total_score": result["total_score"],
+        "total_questions": result["total_questions"],
+        "confidence": round(sum(all_values) / len(all_values), 3) if all_values else 0.0,
+        "question_confidence": per_question,
+    }
+
+
+async def run_cv(request, key_path, worker):
+    """
+    Reads the uploaded image and runs worker on it in the process pool.
+    Returns (key_answers, worker result).
+    """
+    global pending
+
+    # Admission control: refuse work instead of queueing it without bound
+    if pending >= MAX_PENDING:
+        raise HTTPException(status_code=503, detail="Server busy, retry later.",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+    content_length = request.headers.get("content-length")
+    if content_length:
+        try:
+            declared_length = int(content_length)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length header.")
+        if declared_length < 0:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length header.")
+        if declared_length > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image too large.")
+
+    pending += 1
+    try:
+        data = await request.body()
+        if not data:
+            raise HTTPException(status_code=400, detail="Empty request body, send the image bytes.")
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image too large.")
+
+        key_answers = await load_key(key_path)
+        loop = asyncio.get_running_loop()
+        return key_answers, await loop.run_in_executor(executor, worker, data)
+    finally:
+        pending -= 1
+
+
+async def save_result(result, student_id, version, flagged, omr_file, key_id):
+    # CSV appends are serialized so concurrent uploads don't interleave rows
+    async with save_lock:
+        await asyncio.to_thread(save_evaluation, result, student_id, version, flagged,
+                                omr_file, key_id)
+
+
+# --- Routes ---
+@app.get("/api/v1/keys")
+async def list_keys():
+    return {"keys": sorted(os.listdir(ANSWER_FOLDER))}
+
+
+@app.post("/api/v1/score")
+async def score(request: Request, key_id: str, student_id: str = "", version: str = "v1",
+                flagged: bool = False, save: bool = False):
+    key_path = key_path_for(key_id)
+    key_answers, (answers, confidence) = await run_cv(request, key_path, score_image_bytes)
+
+    if answers is None:
+        raise HTTPException(status_code=422, detail="Could not detect an OMR sheet in the image.")
+
+    result = evaluate_results(key_answers, answers)
+    if save:
+        await save_result(result, student_id, version, flagged, "api-upload", key_id)
+
+    return build_response(key_id, answers, confidence, result)
+
+
+@app.post("/api/v1/score-multi")
+async def score_multi(request: Request, key_id: str, version: str = "v1",
+                      flagged: bool = False, save: bool = False):
+    """
+    Scores every sheet in a photo of several sheets laid side by side.
+    Bubble grids that could not be read as a complete sheet are listed in
+    "dropped" so the client can ask for a closer photo.
+    """
+    key_path = key_path_for(key_id)
+    key_answers, (sheets, dropped) = await run_cv(request, key_path, score_image_bytes_multi)
+
+    if not sheets:
+        detail = "Could not detect an OMR sheet in the image."
+        if dropped:
+            detail += f" {len(dropped)} incomplete bubble grid(s) were found."
+        raise HTTPException(status_code=422, detail=detail)
+
+    responses = []
+    for index, sheet in enumerate(sheets):
+        if sheet["answers"] is None:
+            responses.append({"bbox": sheet["bbox"], "error": "Could not read answers."})
+            continue
+        result = evaluate_results(key_answers, sheet["answers"])
+        if save:
+            await save_result(result, "", version, flagged, f"api-upload#{index + 1}", key_id)
+        response = build_response(key_id, sheet["answers"], sheet["confidence"], result)
+        response["bbox"] = sheet["bbox"]
+        responses.append(response)
+
+    return {"sheets": responses, "dropped": dropped}
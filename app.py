@@ -1,11 +1,14 @@
 import os
-import json
 from io import BytesIO
 from datetime import datetime
 import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
 from omr_utils import  evaluate_results, SUBJECTS, REPORT_FILE,save_evaluation
 from files import *
+from pipeline import run_pipeline, score_and_save
+from frames import save_best_frame, VIDEO_EXTENSIONS
+from analytics import item_report, chart_series
+from tilt import reset_batch_stats
 
 
 app = Flask(__name__)
@@ -48,10 +51,14 @@ ANSWER_FOLDER = os.path.join(UPLOAD_FOLDER, 'answers')
 OMR_FOLDER = os.path.join(UPLOAD_FOLDER, 'omr')
 RECTIFIED_FOLDER = os.path.join(UPLOAD_FOLDER, 'rectified')
 JSON_FOLDER = os.path.join(UPLOAD_FOLDER, 'json_results')
+CAPTURE_FOLDER = os.path.join(UPLOAD_FOLDER, 'captures')
 
-for folder in [UPLOAD_FOLDER, ANSWER_FOLDER, OMR_FOLDER, RECTIFIED_FOLDER, JSON_FOLDER]:
+for folder in [UPLOAD_FOLDER, ANSWER_FOLDER, OMR_FOLDER, RECTIFIED_FOLDER, JSON_FOLDER, CAPTURE_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
+# Answer key of the batch the detection statistics (tilt.recent_wins) belong to
+batch_key = None
+
 # --- Home Dashboard ---
 @app.route('/')
 @login_required
@@ -94,14 +101,9 @@ def home():
         avg_scores=avg_scores
     )
 
-# --- Reports Route ---
-@app.route('/reports')
-@login_required
-def reports():
-    df = pd.read_csv(REPORT_FILE) if os.path.isfile(REPORT_FILE) else pd.DataFrame()
-
-    # Filters
-    filters = {
+# --- Report filters ---
+def read_filters():
+    return {
         "student_id": request.args.get("student_id", ""),
         "date": request.args.get("date", ""),
         "version": request.args.get("version", ""),
@@ -110,6 +112,7 @@ def reports():
         "key_file": request.args.get("key_file", "")
     }
 
+def filter_reports(df, filters):
     filtered_df = df.copy()
     if filters["student_id"]:
         filtered_df = filtered_df[
@@ -132,6 +135,17 @@ def reports():
         filtered_df = filtered_df[
             filtered_df["Answer Key"].astype(str).str.contains(filters["key_file"], case=False, na=False)
         ]
+    return filtered_df
+
+# --- Reports Route ---
+@app.route('/reports')
+@login_required
+def reports():
+    df = pd.read_csv(REPORT_FILE) if os.path.isfile(REPORT_FILE) else pd.DataFrame()
+
+    filters = read_filters()
+    filtered_df = filter_reports(df, filters)
+
     # Export options
     export_type = request.args.get("export")
     if export_type == "csv":
@@ -143,28 +157,64 @@ def reports():
         output.seek(0)
         return output.read(), 200, {"Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
 
-    # Prepare data for charts and template
+    # Chart data is fetched separately from /reports/chart-data
     reports = filtered_df.to_dict("records")
-    labels = filtered_df["Date"].tolist() if "Date" in filtered_df.columns else []
-    subject_scores = {s: filtered_df[s].tolist() if s in filtered_df.columns else [] for s in SUBJECTS}
-    overall_scores = filtered_df["Total Score"].tolist() if "Total Score" in filtered_df.columns else []
     versions = filtered_df["Version"].unique().tolist() if "Version" in filtered_df.columns else []
 
     return render_template("reports.html",
         reports=reports,
         subjects=SUBJECTS,
-        labels=json.dumps(labels),
-        subject_scores=json.dumps(subject_scores),
-        overall_scores=json.dumps(overall_scores),
         filters=filters,
         versions=versions
     )
 
+# --- Chart Data Route ---
+# Aggregated chart series per filter set. The cache is dropped whenever the
+# report file changes, i.e. when a new evaluation is saved.
+CHART_CACHE_SIZE = 64
+chart_cache = {"signature": None, "entries": {}}
+
+def report_signature():
+    if not os.path.isfile(REPORT_FILE):
+        return None
+    stat = os.stat(REPORT_FILE)
+    return (stat.st_mtime_ns, stat.st_size)
+
+@app.route('/reports/chart-data')
+@login_required
+def chart_data():
+    filters = read_filters()
+    signature = report_signature()
+    if chart_cache["signature"] != signature:
+        chart_cache["signature"] = signature
+        chart_cache["entries"] = {}
+
+    cache_key = tuple(sorted(filters.items()))
+    if cache_key not in chart_cache["entries"]:
+        df = pd.read_csv(REPORT_FILE) if signature else pd.DataFrame()
+        if len(chart_cache["entries"]) >= CHART_CACHE_SIZE:
+            chart_cache["entries"].clear()
+        chart_cache["entries"][cache_key] = chart_series(filter_reports(df, filters))
+    return jsonify(chart_cache["entries"][cache_key])
+
+# --- Item Analysis Route ---
+@app.route('/reports/items')
+@login_required
+def item_analysis():
+    version = request.args.get("version", "")
+    report = item_report(version or None)
+    return render_template("item_analysis.html",
+        report=report,
+        subjects=SUBJECTS,
+        version=version
+    )
+
 # --- Evaluate Route ---
 @app.route('/evaluate', methods=['GET', 'POST'])
 @login_required
 
 def evaluate():
+    global batch_key
     existing_keys = os.listdir(ANSWER_FOLDER)
     existing_omr = os.listdir(OMR_FOLDER)
     versions = ["v1"]
@@ -190,6 +240,29 @@ def evaluate():
             flash(f"Bulk upload complete: {success}/{total} sheets uploaded.", "success")
             return redirect(url_for("evaluate"))
 
+        # Upload a video or burst of photos of one sheet; only the best frame is kept
+        if "omr_capture" in request.files and request.files.getlist("omr_capture")[0].filename:
+            files = [f for f in request.files.getlist("omr_capture") if f.filename]
+            saved = []
+            for file in files:
+                path = os.path.join(CAPTURE_FOLDER, file.filename)
+                file.save(path)
+                saved.append(path)
+
+            videos = [p for p in saved if p.lower().endswith(VIDEO_EXTENSIONS)]
+            source = videos[0] if videos else saved
+            stem = os.path.splitext(os.path.basename(saved[0]))[0]
+            filename = f"{stem}_best.jpg"
+            stats = save_best_frame(source, os.path.join(OMR_FOLDER, filename))
+
+            for path in saved:
+                os.remove(path)
+            if stats["frame"] is None:
+                flash(f"No usable frame found in {stats['frames_scored']} frames, please retake.", "danger")
+            else:
+                flash(f"Best frame of {stats['frames_scored']} saved as '{filename}'.", "success")
+            return redirect(url_for("evaluate"))
+
         # Upload single OMR sheet
         if "omr_file" in request.files and request.files["omr_file"].filename:
             file = request.files["omr_file"]
@@ -213,12 +286,37 @@ def evaluate():
                 flash("Please select both Answer Key and OMR Sheet.", "danger")
                 return redirect(url_for("evaluate"))
 
-            for omr_file in selected_omr_list:
-                marked_answers = process_omr_sheet(os.path.join(OMR_FOLDER, omr_file))
-                key_answers = process_answer_key(os.path.join(ANSWER_FOLDER, selected_key))
-                
-                result = evaluate_results(key_answers, marked_answers)
-                save_evaluation(result, student_id, version, flagged, omr_file, selected_key)
+            key_answers = process_answer_key(os.path.join(ANSWER_FOLDER, selected_key))
+            # Sheets marked against one key come from the same exam; another key starts a new batch
+            if selected_key != batch_key:
+                reset_batch_stats()
+                batch_key = selected_key
+
+            # Several sheets go through the streaming pipeline to use all cores
+            if len(selected_omr_list) > 1:
+                omr_paths = [os.path.join(OMR_FOLDER, omr_file) for omr_file in selected_omr_list]
+                outcomes = run_pipeline(omr_paths, key_answers, student_id, version, flagged, selected_key)
+                failed = [omr_file for omr_file, res, _ in outcomes if res is None]
+                # One student ID for several sheets: run_pipeline does not look for duplicates
+                for omr_file, res, _ in outcomes:
+                    if res is not None:
+                        result = res
+                if failed:
+                    flash(f"Could not process: {', '.join(failed)}", "warning")
+            else:
+                for omr_file in selected_omr_list:
+                    marked_answers, sheet_hash, duplicate = process_omr_sheet_deduped(
+                        os.path.join(OMR_FOLDER, omr_file), student_id)
+                    if marked_answers is None:
+                        flash(f"Could not process: {omr_file}", "warning")
+                        continue
+
+                    result, duplicate_of = score_and_save(marked_answers, sheet_hash, duplicate, key_answers,
+                                                          omr_file, student_id, version, flagged, selected_key)
+                    if duplicate_of:
+                        # Same student's sheet uploaded again under another name: don't count it twice
+                        flash(f"'{omr_file}' is a probable duplicate of '{duplicate_of}'. "
+                              "Reused its result and did not save it again.", "warning")
 
     return render_template("evaluate.html",
         existing_keys=existing_keys,
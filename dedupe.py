@@ -0,0 +1,93 @@
+"""
+Index of evaluated sheets for duplicate upload detection.
+
+Each rectified sheet is reduced to a fill hash (s2.sheet_hash): one bit per
+bubble, set when the bubble is filled. The printed layout is the same on
+every sheet and does not enter the hash, so a retake of the same sheet
+(another photo, another phone, other lighting) sets the same bits up to the
+few bubbles that sit right at the fill threshold. A new upload within
+MAX_HASH_DISTANCE bits of an indexed sheet of the same student is a
+probable duplicate, and its stored answers are used instead of reading the
+sheet again.
+
+Only a student ID entered for this one sheet is trusted: sheets without an
+ID, or evaluated in bulk under one shared ID, are never matched or indexed.
+Sheets with fewer than MIN_MARKED_BUBBLES filled bubbles are never matched,
+as blank or nearly blank sheets all look alike.
+
+The index is append-only, written under store.lock (see answer_store):
+    uploads/sheet_index/hashes.bin     HASH_BYTES packed hash bits per sheet
+    uploads/sheet_index/sheets.jsonl   one {"omr_file", "student_id", "answers"} per sheet
+"""
+import json
+import os
+
+import numpy as np
+
+from answer_store import store_lock, NUM_ITEMS
+
+INDEX_FOLDER = os.path.join("uploads", "sheet_index")
+HASH_BYTES = NUM_ITEMS * 4 // 8   # one bit per bubble, 4 options per question
+MAX_HASH_DISTANCE = 6             # differing bits; retakes of the sample sheets differ in up to 5
+MIN_MARKED_BUBBLES = 10
+
+index_cache = {"signature": None, "hashes": None, "entries": None}
+
+
+def index_paths(folder=INDEX_FOLDER):
+    return os.path.join(folder, "hashes.bin"), os.path.join(folder, "sheets.jsonl")
+
+
+def load_index(folder=INDEX_FOLDER):
+    """Returns (hashes, entries), re-reading the files only when they have grown."""
+    hashes_path, entries_path = index_paths(folder)
+    if not os.path.isfile(hashes_path) or not os.path.isfile(entries_path):
+        return np.zeros((0, HASH_BYTES), dtype=np.uint8), []
+
+    signature = (folder, os.path.getsize(hashes_path), os.path.getsize(entries_path))
+    if index_cache["signature"] != signature:
+        # Read under the lock, so never a sheet that is only half written
+        with store_lock(folder):
+            signature = (folder, os.path.getsize(hashes_path), os.path.getsize(entries_path))
+            hashes = np.fromfile(hashes_path, dtype=np.uint8).reshape(-1, HASH_BYTES)
+            with open(entries_path) as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        index_cache.update(signature=signature, hashes=hashes, entries=entries)
+    return index_cache["hashes"], index_cache["entries"]
+
+
+def find_duplicate(sheet_hash, student_id, folder=INDEX_FOLDER):
+    """
+    Returns the indexed entry of the same student closest to sheet_hash if it
+    is within MAX_HASH_DISTANCE bits, else None.
+    """
+    if not student_id:
+        return None
+    if np.bitwise_count(sheet_hash).sum() < MIN_MARKED_BUBBLES:
+        return None
+    hashes, entries = load_index(folder)
+    same_student = np.flatnonzero([e["student_id"] == student_id for e in entries])
+    if len(same_student) == 0:
+        return None
+    distances = np.bitwise_count(np.bitwise_xor(hashes[same_student], sheet_hash)).sum(axis=1)
+    best = int(np.argmin(distances))
+    if distances[best] > MAX_HASH_DISTANCE:
+        return None
+    entry = entries[same_student[best]]
+    print(f"Probable duplicate of {entry['omr_file']} ({distances[best]} bubbles differ).")
+    return entry
+
+
+def add_to_index(sheet_hash, answers, omr_file, student_id, folder=INDEX_FOLDER):
+    """Indexes one read sheet. Sheets without a student ID could never match and are skipped."""
+    if not student_id:
+        return
+    os.makedirs(folder, exist_ok=True)
+    hashes_path, entries_path = index_paths(folder)
+    # Both files must grow by the same sheet, whichever process appends next
+    with store_lock(folder):
+        with open(entries_path, "a") as f:
+            f.write(json.dumps({"omr_file": omr_file, "student_id": student_id,
+                                "answers": answers}) + "\n")
+        with open(hashes_path, "ab") as f:
+            f.write(np.asarray(sheet_hash, dtype=np.uint8).tobytes())
@@ -1,6 +1,7 @@
 import pandas as pd
 import re
-from s2 import process_with_fallback as process_omr
+import cv2
+from s2 import process_with_fallback as process_omr, process_image_deduped
 import os
 
 
@@ -30,6 +31,13 @@ def process_answer_key(filepath):
 def process_omr_sheet(filepath):
     return process_omr(filepath)
 
+def process_omr_sheet_deduped(filepath, student_id):
+    """Returns (answers, sheet hash, duplicate entry or None), see s2.process_image_deduped."""
+    image = cv2.imread(filepath)
+    if image is None:
+        return None, None, None
+    return process_image_deduped(image, student_id)
+
 def split_save_xlsx(filepath):
     xls = pd.ExcelFile(filepath)
     base_name = os.path.splitext(os.path.basename(filepath))[0]
@@ -0,0 +1,112 @@
+"""
+Best-frame selection for burst or video captures of one OMR sheet.
+
+Every frame first gets a cheap sharpness score. Frames that are too blurry
+are dropped without running detection; the others are scored by how many
+bubbles the warp_image detection finds. The scan stops as soon as a frame
+is both sharp and fully detectable, and only that frame is kept as the
+uploaded sheet.
+"""
+import os
+
+import cv2
+
+from tilt import prepare_image, detect_bubbles
+
+# --- Configuration ---
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".3gp", ".webm")
+FRAME_STEP = 5            # only look at every 5th video frame
+MAX_FRAMES = 60           # frames scored at most per capture
+SHARPNESS_HEIGHT = 500    # frames are downscaled to this height for the blur check
+MIN_SHARPNESS = 50.0      # below this a frame is too blurry to try
+GOOD_SHARPNESS = 150.0
+GOOD_BUBBLE_COUNT = 300   # out of 400 bubbles on a sheet
+
+
+def iter_frames(source):
+    """Yields (index, frame) from a video file or a list of image paths."""
+    if isinstance(source, str) and source.lower().endswith(VIDEO_EXTENSIONS):
+        capture = cv2.VideoCapture(source)
+        index = 0
+        yielded = 0
+        try:
+            while yielded < MAX_FRAMES:
+                ok = capture.grab()
+                if not ok:
+                    break
+                if index % FRAME_STEP == 0:
+                    ok, frame = capture.retrieve()
+                    if ok:
+                        yield index, frame
+                        yielded += 1
+                index += 1
+        finally:
+            capture.release()
+        return
+
+    paths = [source] if isinstance(source, str) else list(source)
+    for index, path in enumerate(paths[:MAX_FRAMES]):
+        frame = cv2.imread(path)
+        if frame is not None:
+            yield index, frame
+
+
+def sharpness(frame):
+    """Variance of the Laplacian on a downscaled grayscale frame; higher is sharper."""
+    ratio = SHARPNESS_HEIGHT / float(frame.shape[0])
+    small = cv2.resize(frame, (max(int(frame.shape[1] * ratio), 1), SHARPNESS_HEIGHT),
+                       interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def bubble_count(frame):
+    """Number of bubbles the warp_image detection finds in the frame (0 if it fails)."""
+    _, image, gray, _ = prepare_image(frame)
+    # Frames are candidates, not sheets: they must not steer the batch statistics
+    centers = detect_bubbles(image, gray, record=False)
+    return 0 if centers is None else len(centers)
+
+
+def select_best_frame(source):
+    """
+    Scores the frames of source and returns (frame, stats) for the best one,
+    or (None, stats) if no frame was usable. stats holds the chosen frame
+    index, its scores and how many frames were looked at.
+    """
+    best, best_key = None, None
+    stats = {"frame": None, "sharpness": 0.0, "bubbles": 0, "frames_scored": 0}
+
+    for index, frame in iter_frames(source):
+        stats["frames_scored"] += 1
+        sharp = sharpness(frame)
+        if sharp < MIN_SHARPNESS:
+            print(f"Frame {index}: too blurry ({sharp:.1f}), skipped.")
+            continue
+
+        bubbles = bubble_count(frame)
+        print(f"Frame {index}: sharpness {sharp:.1f}, {bubbles} bubbles.")
+        key = (bubbles, sharp)
+        if best_key is None or key > best_key:
+            best, best_key = frame, key
+            stats.update({"frame": index, "sharpness": sharp, "bubbles": bubbles})
+
+        # Good enough: stop without scoring the remaining frames
+        if sharp >= GOOD_SHARPNESS and bubbles >= GOOD_BUBBLE_COUNT:
+            print(f"Frame {index} is good enough, stopping early.")
+            break
+
+    if best is not None and stats["bubbles"] == 0:
+        best = None
+    return best, stats
+
+
+def save_best_frame(source, out_path):
+    """Writes the best frame of source to out_path. Returns stats, with stats["frame"] None on failure."""
+    frame, stats = select_best_frame(source)
+    if frame is None:
+        stats["frame"] = None
+        return stats
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    cv2.imwrite(out_path, frame)
+    return stats
@@ -3,6 +3,8 @@ import os
 from datetime import datetime
 import random
 
+from answer_store import append_answers
+
 SUBJECTS = ["Python", "EDA", "SQL", "POWER BI", "Satistics"]
 REPORT_FILE = "uploads/evaluations.csv"
 
@@ -21,7 +23,9 @@ def evaluate_results(key, marked):
         "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "result": results,
         "total_score": total_score,
-        "total_questions": total_questions
+        "total_questions": total_questions,
+        "answers": marked,
+        "key": key
     }
     return result_data
 
@@ -43,3 +47,7 @@ def save_evaluation(result, student_id, version, flagged, omr_file, key_file):
         row += [student_id, version, flagged]
         
         writer.writerow(row)
+
+    # Keep the raw per-question answers for item analysis
+    if "answers" in result:
+        append_answers(result["answers"], result["key"], version)
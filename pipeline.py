@@ -0,0 +1,177 @@
+"""
+Streaming pipeline for bulk evaluation.
+
+    decode (threads) -> detect / warp / extract (process pool) -> score / save (calling thread)
+
+Every sheet holds a slot from the moment its file is read until its row is
+saved, so at most max_in_flight decoded images exist at any time. Decoded
+images reach the CV processes through shared memory instead of being
+pickled through the pool's pipe.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+from dedupe import add_to_index
+from omr_utils import evaluate_results, save_evaluation
+from s2 import process_image_deduped
+from tilt import reset_batch_stats, batch_stats, load_batch_stats, sheet_stats, add_sheet_stats
+
+# --- Configuration ---
+DECODE_THREADS = 2
+CV_WORKERS = os.cpu_count() or 1
+
+
+# --- CV stage (runs in the process pool) ---
+def process_shared(shm_name, shape, dtype, stats, student_id):
+    """
+    Runs the CV pipeline on an image stored in a shared memory block, with the
+    detection statistics of the batch (tilt.batch_stats). Returns (answers,
+    hash, duplicate, sheet_stats), see s2.process_image_deduped, so that the
+    calling process can save the sheet and record the winners.
+    """
+    load_batch_stats(stats)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        answers, fill_hash, duplicate = process_image_deduped(image, student_id)
+    except Exception as e:
+        print(f"Error while processing shared image {shm_name}: {e}")
+        answers = fill_hash = duplicate = None
+    # The view must be gone before the block can be closed
+    del image
+    shm.close()
+    return answers, fill_hash, duplicate, sheet_stats(stats)
+
+
+def to_shared(image):
+    shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+    return shm
+
+
+def score_and_save(answers, fill_hash, duplicate, key_answers, omr_file, student_id, version,
+                   flagged, key_file, shared_id=False):
+    """
+    Scores one sheet read by s2.process_image_deduped and appends its row
+    with save_evaluation, unless it is a probable duplicate of a sheet
+    uploaded under another name. Returns (result, duplicate_of);
+    duplicate_of names the original upload or is None. shared_id means
+    student_id was entered once for several sheets: it does not identify
+    this one, so the sheet is not indexed.
+    """
+    if duplicate is None and not shared_id:
+        add_to_index(fill_hash, answers, omr_file, student_id)
+
+    result = evaluate_results(key_answers, answers)
+    if duplicate is not None and duplicate["omr_file"] != omr_file:
+        return result, duplicate["omr_file"]
+    save_evaluation(result, student_id, version, flagged, omr_file, key_file)
+    return result, None
+
+
+def run_pipeline(omr_paths, key_answers, student_id, version, flagged, key_file,
+                 workers=CV_WORKERS, decode_threads=DECODE_THREADS, max_in_flight=None):
+    """
+    Evaluates every sheet in omr_paths against key_answers and appends the
+    results with save_evaluation. Returns a list of (omr_file, result,
+    duplicate_of) in completion order; result is None for sheets that could
+    not be read. A single sheet that is a probable duplicate of an indexed
+    sheet of the same student (see dedupe) is scored from the stored answers
+    but not saved again; duplicate_of names the original upload. Several
+    sheets share one student_id, so they are neither matched nor indexed.
+    Detection statistics
+    carry over from earlier sheets; call tilt.reset_batch_stats first to
+    start a new batch.
+    """
+    max_in_flight = max_in_flight or workers * 2
+    slots = threading.BoundedSemaphore(max_in_flight)
+    path_queue = queue.Queue()
+    done_queue = queue.Queue(maxsize=max_in_flight)
+    for path in omr_paths:
+        path_queue.put(path)
+
+    # One student ID entered for several sheets says nothing about which is whose
+    shared_id = len(omr_paths) > 1
+    match_id = "" if shared_id else student_id
+
+    outcomes = []
+    # Workers detect with the statistics of this process and report back, so
+    # every sheet of the batch counts, whichever worker reads it
+    stats_lock = threading.Lock()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        def decode_stage():
+            while True:
+                try:
+                    path = path_queue.get_nowait()
+                except queue.Empty:
+                    return
+                # Backpressure: wait until a sheet has left the pipeline
+                slots.acquire()
+                image = cv2.imread(path)
+                if image is None:
+                    print(f"Error: Could not load image at {path}.")
+                    done_queue.put((path, None, None))
+                    continue
+                shm = None
+                try:
+                    shm = to_shared(image)
+                    shape, dtype = image.shape, image.dtype.str
+                    del image
+                    with stats_lock:
+                        stats = batch_stats()
+                    future = pool.submit(process_shared, shm.name, shape, dtype, stats, match_id)
+                except Exception as e:
+                    # e.g. BrokenProcessPool after a worker died: the sheet still has to
+                    # leave the pipeline, or the persist stage waits for it forever
+                    print(f"Error while submitting {path}: {e}")
+                    done_queue.put((path, None, shm))
+                    continue
+                future.add_done_callback(lambda f, path=path, shm=shm: done_queue.put((path, f, shm)))
+
+        # The pool forks its workers on the first submit. Do that here, before the
+        # decode threads exist: a child forked while a decoder holds a lock hangs.
+        # The resource tracker has to run first, or every worker starts its own
+        # and "cleans up" the shared memory blocks it attached to
+        resource_tracker.ensure_running()
+        pool.submit(reset_batch_stats).result()
+
+        decoders = [threading.Thread(target=decode_stage, daemon=True) for _ in range(decode_threads)]
+        for t in decoders:
+            t.start()
+
+        # --- Persist stage ---
+        for _ in range(len(omr_paths)):
+            path, future, shm = done_queue.get()
+            answers = fill_hash = duplicate = None
+            try:
+                if future is not None:
+                    answers, fill_hash, duplicate, sheet = future.result()
+                    with stats_lock:
+                        add_sheet_stats(sheet)
+            except Exception as e:
+                print(f"Error while processing {path}: {e}")
+            finally:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+            slots.release()
+
+            omr_file = os.path.basename(path)
+            if answers is None:
+                outcomes.append((omr_file, None, None))
+                continue
+            result, duplicate_of = score_and_save(answers, fill_hash, duplicate, key_answers, omr_file,
+                                                  student_id, version, flagged, key_file, shared_id)
+            outcomes.append((omr_file, result, duplicate_of))
+
+        for t in decoders:
+            t.join()
+
+    return outcomes
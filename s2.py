@@ -2,13 +2,21 @@ import cv2
 import numpy as np
 import os
 
-from tilt import warp_image
+from tilt import warp_image, rectify_sheet, rectify_sheets
+from dedupe import find_duplicate
 
 # --- Configuration ---
 FILLED_BUBBLE_THRESHOLD = 0.6
-ADAPTIVE_THRESH_BLOCK_SIZE = 15
-ADAPTIVE_THRESH_C = 4
+ADAPTIVE_THRESH_BLOCK_SIZE = 51
+ADAPTIVE_THRESH_C = 15
 MIN_INITIAL_AREA = 50
+HASH_FILL_THRESHOLD = 0.3  # share of a bubble cell that is ink; filled ~0.42, empty ~0.17
+
+# HSV ranges of the red circles drawn around filled bubbles (red wraps around hue 0)
+RED_HSV_RANGES = [
+    ((0, 120, 70), (10, 255, 255)),
+    ((170, 120, 70), (180, 255, 255)),
+]
 
 NUM_SUBJECTS = 5      # 5 columns (subjects)
 NUM_OPTIONS = 4       # A, B, C, D
@@ -148,9 +156,9 @@ def visualize_grid(cropped_img):
     # cv2.waitKey(0)
     cv2.destroyAllWindows()
 
-def extract_answers_from_cropped(cropped_vis, cropped_orig):
+def extract_answers_from_cropped(cropped_vis, cropped_orig, red_ranges=RED_HSV_RANGES, grid_weights=None):
     h, w = cropped_vis.shape[:2]
-    widths, heights, total_rows, total_cols = compute_grid_layout(w, h)
+    widths, heights, total_rows, total_cols = compute_grid_layout(w, h, **(grid_weights or {}))
 
     # Map usable columns (skip blank gaps)
     col_to_subj_opt = {}
@@ -164,14 +172,14 @@ def extract_answers_from_cropped(cropped_vis, cropped_orig):
 
     # Convert to HSV for red detection (highlighted circles)
     hsv = cv2.cvtColor(cropped_vis, cv2.COLOR_BGR2HSV)
-    lower1 = np.array([0, 120, 70]); upper1 = np.array([10, 255, 255])
-    lower2 = np.array([170, 120, 70]); upper2 = np.array([180, 255, 255])
-    mask1 = cv2.inRange(hsv, lower1, upper1)
-    mask2 = cv2.inRange(hsv, lower2, upper2)
-    red_mask = cv2.bitwise_or(mask1, mask2)
+    red_mask = np.zeros(hsv.shape[:2], dtype="uint8")
+    for lower, upper in red_ranges:
+        mask = cv2.inRange(hsv, np.array(lower), np.array(upper))
+        red_mask = cv2.bitwise_or(red_mask, mask)
 
     # Answer storage
     answers = [["None"] * NUM_QUESTIONS for _ in range(NUM_SUBJECTS)]
+    confidence = [[0.0] * NUM_QUESTIONS for _ in range(NUM_SUBJECTS)]
 
     # Precompute grid positions
     cum_widths = np.cumsum([0] + widths)
@@ -190,6 +198,7 @@ def extract_answers_from_cropped(cropped_vis, cropped_orig):
         y1, y2 = max(0, y1), min(h, y2)
 
         best_hits = {}
+        runner_up = {}
         for col in range(total_cols):
             if col not in col_to_subj_opt:
                 continue
@@ -208,12 +217,18 @@ def extract_answers_from_cropped(cropped_vis, cropped_orig):
             prev = best_hits.get(subj, (None, 0))
             if red_pixels > prev[1]:
                 best_hits[subj] = (opt, red_pixels)
+                runner_up[subj] = prev[1]
+            elif red_pixels > runner_up.get(subj, 0):
+                runner_up[subj] = red_pixels
 
         # Assign best option per subject
         for subj_idx in range(NUM_SUBJECTS):
             if subj_idx in best_hits:
                 opt_idx = best_hits[subj_idx][0]
                 answers[subj_idx][q - 1] = chr(65 + opt_idx)
+                # Confidence: how clearly the chosen option beats the next best one
+                best_pixels = best_hits[subj_idx][1]
+                confidence[subj_idx][q - 1] = 1.0 - runner_up.get(subj_idx, 0) / float(best_pixels)
 
                 # Draw annotation
                 chosen_col = [k for k, v in col_to_subj_opt.items() if v == (subj_idx, opt_idx)][0]
@@ -228,7 +243,7 @@ def extract_answers_from_cropped(cropped_vis, cropped_orig):
     # for subj_idx in range(NUM_SUBJECTS):
     #     print(f"Subject {subj_idx+1} Answers:", answers[subj_idx])
 
-    return answers, cropped_vis
+    return answers, confidence, cropped_vis
 
 
 # -------------------------
@@ -238,7 +253,7 @@ def process_with_fallback(image_path_original):
     warpedImgLocation = warp_image(image_path_original)
     image_path = warpedImgLocation
 
-    if not os.path.exists(image_path):
+    if image_path is None or not os.path.exists(image_path):
         print(f"Error: Image file not found at {image_path}")
         return None
 
@@ -246,7 +261,92 @@ def process_with_fallback(image_path_original):
     if image is None:
         print(f"Error: Could not load image at {image_path}. Please check the path or format.")
         return None
-    
+
+    answers, _ = read_answers(image)
+    return answers
+
+
+def process_image(image):
+    """
+    Same as process_with_fallback but works on an already decoded image and
+    keeps everything in memory. Returns (answers, confidence) or (None, None).
+    """
+    warped = rectify_sheet(image)
+    if warped is None:
+        print("Error: Could not rectify the sheet.")
+        return None, None
+    return read_answers(warped)
+
+
+def process_image_deduped(image, student_id):
+    """
+    Like process_image, but looks the rectified sheet up in the duplicate
+    index (dedupe) before reading it; on a match the stored answers are used
+    and read_answers is skipped. Returns (answers, hash, duplicate entry or
+    None), or (None, None, None). Adding new sheets to the index is up to the
+    caller, once the sheet has been saved.
+    """
+    warped = rectify_sheet(image)
+    if warped is None:
+        print("Error: Could not rectify the sheet.")
+        return None, None, None
+    fill_hash = sheet_hash(warped)
+    duplicate = find_duplicate(fill_hash, student_id)
+    if duplicate is not None:
+        return duplicate["answers"], fill_hash, duplicate
+    answers, _ = read_answers(warped)
+    return answers, fill_hash, None
+
+
+def process_image_multi(image):
+    """
+    Processes every sheet found in one photo or scan page.
+    Returns (results, dropped): results is a list of {"bbox", "answers",
+    "confidence"}, one per sheet, in reading order; dropped lists the bubble
+    grids that could not be read as a sheet (see rectify_sheets). Boxes are
+    [x, y, w, h] in the input image.
+    """
+    sheets, dropped = rectify_sheets(image)
+    results = []
+    for sheet in sheets:
+        answers, confidence = read_answers(sheet["warped"])
+        results.append({"bbox": sheet["bbox"], "answers": answers, "confidence": confidence})
+    return results, dropped
+
+
+def sheet_hash(image, block_size=ADAPTIVE_THRESH_BLOCK_SIZE, thresh_c=ADAPTIVE_THRESH_C):
+    """
+    Fill hash of a warped sheet for dedupe: one bit per bubble (subject by
+    subject, question by question, option by option), set when its grid cell
+    is filled, packed into 50 bytes.
+    """
+    ratio = 1000.0 / image.shape[0]
+    image = cv2.resize(image, (int(image.shape[1] * ratio), 1000), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY_INV, block_size, thresh_c)
+
+    h, w = thresh.shape
+    widths, heights, _, _ = compute_grid_layout(w, h)
+    # Ink share of every grid cell, including the blank gaps
+    cum_widths, cum_heights = np.cumsum([0] + widths), np.cumsum([0] + heights)
+    ink = np.add.reduceat(np.add.reduceat(thresh, cum_heights[:-1], axis=0, dtype=np.int64),
+                          cum_widths[:-1], axis=1) / (255.0 * np.outer(heights, widths))
+
+    rows = [q + (q // 5) * 2 for q in range(NUM_QUESTIONS)]
+    cols = [subj * (NUM_OPTIONS + 2) + opt for subj in range(NUM_SUBJECTS) for opt in range(NUM_OPTIONS)]
+    cells = ink[np.ix_(rows, cols)].reshape(NUM_QUESTIONS, NUM_SUBJECTS, NUM_OPTIONS)
+    return np.packbits(cells.transpose(1, 0, 2).reshape(-1) > HASH_FILL_THRESHOLD)
+
+
+def read_answers(image, fill_threshold=FILLED_BUBBLE_THRESHOLD,
+                 block_size=ADAPTIVE_THRESH_BLOCK_SIZE, thresh_c=ADAPTIVE_THRESH_C,
+                 red_ranges=RED_HSV_RANGES, grid_weights=None):
+    """
+    Reads the marked answers from a warped sheet. Returns (answers, confidence).
+    The keyword arguments default to the module configuration and are
+    overridden by the parameter tuning harness (tune.py).
+    """
     ratio = 1000.0 / image.shape[0]
     new_width = int(image.shape[1] * ratio)
     image = cv2.resize(image, (new_width, 1000), interpolation=cv2.INTER_AREA)
@@ -255,7 +355,7 @@ def process_with_fallback(image_path_original):
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     
     thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                       cv2.THRESH_BINARY_INV, 51, 15)
+                                       cv2.THRESH_BINARY_INV, block_size, thresh_c)
     # cv2.imwrite("debug_thresholded.jpg", thresh)
 
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -287,13 +387,15 @@ def process_with_fallback(image_path_original):
         center_x, center_y = x + w//2, y + h//2
         radius = max(w, h)//2
         cv2.circle(vis_resized, (center_x, center_y), radius, (0, 255, 0), 2)
-        mask = np.zeros(thresh.shape, dtype="uint8")
-        cv2.drawContours(mask, [c], -1, 255, -1)
-        masked_thresh = cv2.bitwise_and(thresh, thresh, mask=mask)
+        # Mask only the bubble's bounding box instead of the whole sheet
+        mask = np.zeros((h, w), dtype="uint8")
+        cv2.drawContours(mask, [c], -1, 255, -1, offset=(-x, -y))
+        thresh_roi = thresh[y:y + h, x:x + w]
+        masked_thresh = cv2.bitwise_and(thresh_roi, thresh_roi, mask=mask)
         filled_pixels = cv2.countNonZero(masked_thresh)
         total_pixels = cv2.countNonZero(mask)
         fill_ratio = filled_pixels / float(total_pixels) if total_pixels > 0 else 0
-        if fill_ratio > FILLED_BUBBLE_THRESHOLD:
+        if fill_ratio > fill_threshold:
             cv2.circle(vis_resized, (center_x, center_y), radius, (0, 0, 255), 2)
 
     if bubble_contours:
@@ -305,7 +407,8 @@ def process_with_fallback(image_path_original):
         # show grid overlay for visual verification
         visualize_grid(cropped_vis)
 
-        answers, annotated = extract_answers_from_cropped(cropped_vis, cropped_orig)
+        answers, confidence, annotated = extract_answers_from_cropped(cropped_vis, cropped_orig,
+                                                                      red_ranges, grid_weights)
         for subj_idx, subj_answers in enumerate(answers, start=1):
             print(f"Subject {subj_idx}: {subj_answers}")
         # cv2.imwrite("annotated_extracted_answers.jpg", annotated)
@@ -315,7 +418,9 @@ def process_with_fallback(image_path_original):
     # cv2.imshow("Detected Bubbles", cv2.resize(vis_resized, (600, 750)))
     # cv2.waitKey(0)
     cv2.destroyAllWindows()
-    return answers if bubble_contours else None
+    if not bubble_contours:
+        return None, None
+    return answers, confidence
 
 # -------------------------
 # Run
@@ -0,0 +1,109 @@
+import os
+import sys
+import threading
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dedupe
+import s2
+import tilt
+
+OMR_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uploads", "omr")
+ANSWERS = [[["A", "B", "C", "D"][(s + q) % 4] for q in range(20)] for s in range(5)]
+
+
+def fill_bits(answers):
+    """Hash bits of a sheet with exactly the given bubbles filled."""
+    return np.array([opt == answer for subject in answers for answer in subject for opt in "ABCD"])
+
+
+def near_copy(bits, changes):
+    """The bits with `changes` bubbles of the first questions flipped."""
+    copy = bits.copy()
+    copy[:changes] = ~copy[:changes]
+    return np.packbits(copy)
+
+
+def test_retake_with_a_few_bubbles_off_is_a_duplicate(tmp_path):
+    bits = fill_bits(ANSWERS)
+    dedupe.add_to_index(np.packbits(bits), ANSWERS, "Img1.jpeg", "S1", folder=str(tmp_path))
+    for changes in (0, dedupe.MAX_HASH_DISTANCE):
+        duplicate = dedupe.find_duplicate(near_copy(bits, changes), "S1", folder=str(tmp_path))
+        assert duplicate["omr_file"] == "Img1.jpeg" and duplicate["answers"] == ANSWERS
+
+
+def test_sheets_with_other_answers_are_not_duplicates(tmp_path):
+    bits = fill_bits(ANSWERS)
+    dedupe.add_to_index(np.packbits(bits), ANSWERS, "Img1.jpeg", "S1", folder=str(tmp_path))
+    # Every changed answer clears one bubble and fills another
+    assert dedupe.find_duplicate(near_copy(bits, 2 * 4), "S1", folder=str(tmp_path)) is None
+
+
+def test_blank_or_other_student_id_never_matches(tmp_path):
+    h = np.packbits(fill_bits(ANSWERS))
+    dedupe.add_to_index(h, ANSWERS, "Img1.jpeg", "S1", folder=str(tmp_path))
+    dedupe.add_to_index(h, ANSWERS, "Img2.jpeg", "", folder=str(tmp_path))
+    assert dedupe.find_duplicate(h, "S2", folder=str(tmp_path)) is None
+    assert dedupe.find_duplicate(h, "", folder=str(tmp_path)) is None
+    assert len(dedupe.load_index(str(tmp_path))[1]) == 1
+
+
+def test_blank_sheets_are_not_duplicates(tmp_path):
+    blank = np.packbits(np.zeros(400, dtype=bool))
+    dedupe.add_to_index(blank, [[None] * 20] * 5, "blank1.jpeg", "S1", folder=str(tmp_path))
+    assert dedupe.find_duplicate(blank, "S1", folder=str(tmp_path)) is None
+
+
+def test_concurrent_appends_keep_hashes_and_entries_in_step(tmp_path):
+    def add(start):
+        for i in range(start, start + 25):
+            h = np.packbits(np.arange(400) < i + 10)
+            dedupe.add_to_index(h, ANSWERS, f"sheet{i}.jpeg", "S1", folder=str(tmp_path))
+
+    threads = [threading.Thread(target=add, args=(start,)) for start in range(0, 200, 25)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    hashes, entries = dedupe.load_index(str(tmp_path))
+    assert len(hashes) == len(entries) == 200
+    for h, entry in zip(hashes, entries):
+        assert np.bitwise_count(h).sum() == int(entry["omr_file"][5:-5]) + 10
+
+
+def rectified(name):
+    tilt.reset_batch_stats()
+    return tilt.rectify_sheet(cv2.imread(os.path.join(OMR_FOLDER, name)))
+
+
+def test_retakes_of_a_sample_sheet_hash_alike():
+    # Img19 and Img6 are other photos of the sheets in Img1 and Img2
+    img1, img19, img2, img6 = (s2.sheet_hash(rectified(name))
+                               for name in ("Img1.jpeg", "Img19.jpeg", "Img2.jpeg", "Img6.jpeg"))
+    assert np.bitwise_count(img1 ^ img19).sum() <= dedupe.MAX_HASH_DISTANCE
+    assert np.bitwise_count(img2 ^ img6).sum() <= dedupe.MAX_HASH_DISTANCE
+    assert np.bitwise_count(img1 ^ img2).sum() > 10 * dedupe.MAX_HASH_DISTANCE
+
+
+def test_duplicate_is_not_read_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    reads = []
+    monkeypatch.setattr(s2, "read_answers", lambda warped: (reads.append(1) or ANSWERS, None))
+
+    def process(name, student_id):
+        tilt.reset_batch_stats()
+        return s2.process_image_deduped(cv2.imread(os.path.join(OMR_FOLDER, name)), student_id)
+
+    answers, h, duplicate = process("Img1.jpeg", "S1")
+    assert duplicate is None
+    dedupe.add_to_index(h, answers, "Img1.jpeg", "S1")
+
+    answers, _, duplicate = process("Img19.jpeg", "S1")
+    assert duplicate["omr_file"] == "Img1.jpeg" and answers == ANSWERS
+    assert len(reads) == 1
+    process("Img19.jpeg", "S2")
+    assert len(reads) == 2
@@ -0,0 +1,117 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tilt
+
+SPACING = 30
+
+
+def sheet_grid():
+    """Bubble centers of one answer grid: 5 subjects x 4 options, 4 blocks of 5 questions."""
+    xs = [100 + SPACING * (subj * 6 + opt) for subj in range(5) for opt in range(4)]
+    ys = [100 + SPACING * (block * 7 + q) for block in range(4) for q in range(5)]
+    return np.array([(x, y) for y in ys for x in xs])
+
+
+@pytest.fixture
+def detectors(monkeypatch):
+    """Hough always fails; contours returns whatever the test puts in contours_result."""
+    calls = {"hough": 0, "contours": 0}
+    state = {"contours_result": sheet_grid()}
+
+    def hough(image, gray):
+        calls["hough"] += 1
+        return None
+
+    def contours(image, gray):
+        calls["contours"] += 1
+        return state["contours_result"]
+
+    monkeypatch.setitem(tilt.BUBBLE_STRATEGIES, "hough", hough)
+    monkeypatch.setitem(tilt.BUBBLE_STRATEGIES, "contours", contours)
+    tilt.reset_batch_stats()
+    yield calls, state
+    tilt.reset_batch_stats()
+
+
+def test_hough_failing_batch_skips_hough(detectors):
+    calls, _ = detectors
+    for _ in range(10):
+        assert tilt.detect_bubbles(None, None) is not None
+    # Only the first sheet and the default order probes (sheets 5 and 10) run Hough
+    assert calls == {"hough": 3, "contours": 10}
+
+
+def test_incomplete_promoted_result_runs_default_chain(detectors):
+    calls, state = detectors
+    tilt.detect_bubbles(None, None)
+    state["contours_result"] = sheet_grid()[:120]
+    tilt.detect_bubbles(None, None)
+    assert calls["hough"] == 2
+
+
+def test_worker_stats_reach_the_batch(detectors):
+    stats = tilt.batch_stats()
+    tilt.detect_bubbles(None, None)
+    sheet = tilt.sheet_stats(stats)
+    tilt.reset_batch_stats()
+    tilt.add_sheet_stats(sheet)
+    assert list(tilt.recent_wins["bubbles"]) == ["contours"]
+    assert tilt.order_strategies("bubbles", tilt.BUBBLE_STRATEGIES) == ["contours", "hough"]
+
+
+OMR_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uploads", "omr")
+
+
+def tile(names, cols, size=None):
+    """The sample sheets laid out cols per row on a white page. Returns (page, cell_w, cell_h)."""
+    images = [cv2.imread(os.path.join(OMR_FOLDER, name)) for name in names]
+    if size:
+        images = [cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA) for image in images]
+    cell_h, cell_w = max(i.shape[0] for i in images), max(i.shape[1] for i in images)
+    rows = (len(images) + cols - 1) // cols
+    page = np.full((cell_h * rows, cell_w * cols, 3), 255, dtype=np.uint8)
+    for index, image in enumerate(images):
+        row, col = divmod(index, cols)
+        page[row * cell_h:row * cell_h + image.shape[0], col * cell_w:col * cell_w + image.shape[1]] = image
+    return page, cell_w, cell_h
+
+
+@pytest.mark.parametrize("names, cols, size", [
+    (["Img1.jpeg", "Img19.jpeg"], 2, None),
+    (["Img3.jpeg", "Img6.jpeg"], 2, 1000),
+    (["Img1.jpeg", "Img2.jpeg", "Img3.jpeg", "Img4.jpeg"], 2, None),
+    # Too small for the detectors at 1000px, found by the finer passes
+    (["Img5.jpeg", "Img6.jpeg", "Img7.jpeg", "Img8.jpeg"], 2, 1000),
+    (["Img16.jpeg", "Img17.jpeg", "Img18.jpeg", "Img19.jpeg"], 2, None),
+])
+def test_every_sheet_of_a_tiled_photo_is_found(names, cols, size):
+    page, cell_w, cell_h = tile(names, cols, size)
+    sheets, dropped = tilt.rectify_sheets(page)
+
+    cells = []
+    for sheet in sheets:
+        x, y, w, h = sheet["bbox"]
+        cells.append((int((y + h / 2) // cell_h), int((x + w / 2) // cell_w)))
+    # One sheet per tile, in reading order
+    assert cells == [divmod(index, cols) for index in range(len(names))]
+    assert all(d["reason"] == "too few bubbles" and d["bubbles"] <= tilt.MIN_CIRCLES_THRESHOLD
+               for d in dropped)
+
+
+def test_corners_off_the_grid_are_dropped_not_warped(monkeypatch):
+    grid = sheet_grid()
+    far = ((100, 100), (348687, 368), (100, 760), (670, 760))
+    monkeypatch.setitem(tilt.CORNER_STRATEGIES, "line_fit", lambda centers: far)
+    monkeypatch.setitem(tilt.CORNER_STRATEGIES, "tilt_robust", lambda centers: far)
+    tilt.reset_batch_stats()
+    page = np.full((1000, 1000, 3), 255, dtype=np.uint8)
+    warped, bbox, bubbles, reason = tilt.warp_grid(page, page, grid, 1.0)
+    assert warped is None and bbox is None
+    assert (bubbles, reason) == (400, "no corners fit the bubble grid")
@@ -1,6 +1,130 @@
 import cv2
 import numpy as np
+from collections import Counter, deque
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+MIN_CIRCLES_THRESHOLD = 50
+EXPECTED_BUBBLES = 400  # 5 subjects x 20 questions x 4 options
+
+# --- Multi-sheet detection ---
+# The widest gap inside a sheet is the one between subject columns, about 3
+# bubble spacings; separate sheets are further apart.
+SHEET_LINK_SPACINGS = 3.5
+SHEET_BUBBLE_TOLERANCE = 0.05 # share of EXPECTED_BUBBLES a complete sheet may be off by
+CANDIDATE_MARGIN = 0.15       # share of a grid's size added around it before detecting again
+SHEET_SPACING = 29            # px between bubbles of a single sheet photo at the 1000px detection scale
+# Detection heights of the passes over a multi-sheet frame. In a photo of
+# four or more sheets the bubbles are too small for the detectors at 1000px,
+# so frames with room for more sheets are searched again at a finer scale.
+SHEET_PASS_HEIGHTS = (1000, 2000, 3000)
+
+# --- Batch statistics ---
+# Sheets in a batch usually come from the same scanner or phone, so the same
+# detection branch keeps winning. We remember the winners of the last few
+# sheets and try the most frequent one first. A promoted winner is only
+# trusted if its result passes a plausibility check, and every
+# DEFAULT_ORDER_EVERY-th sheet runs the original chain so that a stale winner
+# is dropped. Worker processes get a snapshot of the statistics with each
+# sheet (batch_stats) and report their winners back (sheet_stats).
+RECENT_SHEETS_WINDOW = 20
+DEFAULT_ORDER_EVERY = 5
+recent_wins = {
+    "bubbles": deque(maxlen=RECENT_SHEETS_WINDOW),
+    "corners": deque(maxlen=RECENT_SHEETS_WINDOW),
+}
+sheets_seen = Counter()
+last_wins = {}  # stage -> winner, since the last load_batch_stats
+
+# Bubble spacings a bubble may lie outside the corner quad, or a corner outside
+# the bubbles. The sample sheets reach 0.42 (Img16, a bent sheet).
+MAX_CORNER_OVERHANG = 0.5
+
+
+def order_strategies(stage, strategies):
+    """Returns strategy names for a stage, most recent winners first.
+    Ties keep the default order, so an empty history gives the original chain."""
+    counts = Counter(recent_wins[stage])
+    return sorted(strategies, key=lambda name: -counts[name])
+
+
+def record_win(stage, name):
+    recent_wins[stage].append(name)
+    last_wins[stage] = name
+
+
+def reset_batch_stats():
+    """Forget the winners of previous sheets, e.g. when a new batch starts."""
+    for history in recent_wins.values():
+        history.clear()
+    sheets_seen.clear()
+    last_wins.clear()
+
+
+def batch_stats():
+    """The batch statistics as plain data, to hand them to a worker process."""
+    return {stage: list(history) for stage, history in recent_wins.items()}, dict(sheets_seen)
+
+
+def load_batch_stats(stats):
+    """Replaces the statistics of this process with a batch_stats snapshot."""
+    reset_batch_stats()
+    wins, seen = stats
+    for stage, names in wins.items():
+        recent_wins[stage].extend(names)
+    sheets_seen.update(seen)
+
+
+def sheet_stats(stats):
+    """What the sheets processed since load_batch_stats(stats) add to the statistics."""
+    return dict(last_wins), dict(sheets_seen - Counter(stats[1]))
+
+
+def add_sheet_stats(sheet):
+    """Merges the sheet_stats of a worker process into the statistics of this one."""
+    wins, seen = sheet
+    for stage, name in wins.items():
+        record_win(stage, name)
+    sheets_seen.update(seen)
+
+
+def run_chain(stage, strategies, attempt, is_plausible, record=True):
+    """
+    Runs a detection chain. attempt(name) returns the strategy's result or
+    None if it failed. When the recent winners put a strategy ahead of the
+    default order, its result is only accepted if is_plausible(result) holds;
+    otherwise the chain is run in the default order, so the outcome is the one
+    the original chain would have produced. Every DEFAULT_ORDER_EVERY-th sheet
+    runs the default order, and if it finds another winner than the promoted
+    one the history of the stage is dropped. With record=False the default
+    order is used and the batch statistics are left untouched.
+    """
+    default = list(strategies)
+    order, probe = default, False
+    if record:
+        sheets_seen[stage] += 1
+        order = order_strategies(stage, strategies)
+        probe = sheets_seen[stage] % DEFAULT_ORDER_EVERY == 0
+    tried = {}
+    if order[0] != default[0] and not probe:
+        name = order[0]
+        tried[name] = attempt(name)
+        if tried[name] is not None and is_plausible(tried[name]):
+            record_win(stage, name)
+            return tried[name]
+        print(f"Recent winner {name} not confirmed, using the default order.")
+
+    for name in default:
+        result = tried[name] if name in tried else attempt(name)
+        if result is not None:
+            if record:
+                if probe and order[0] != default[0] and name != order[0]:
+                    print(f"Recent winner {order[0]} is stale, forgetting the {stage} history.")
+                    recent_wins[stage].clear()
+                record_win(stage, name)
+            return result
+    return None
+
 
 def find_intersection(line1, line2):
     """Finds the intersection of two lines from cv2.fitLine."""
@@ -14,133 +138,264 @@ def find_intersection(line1, line2):
     return int(round(px)), int(round(py))
 
 
-# Pass in the image to crop it
-def warp_image(image_path):
+# === BUBBLE DETECTION STRATEGIES ===
+def detect_hough(image, gray):
+    """Method 1: HoughCircles. Returns bubble centers or None."""
+    print("Attempting Method 1: HoughCircles...")
+    circles = cv2.HoughCircles(
+        gray, cv2.HOUGH_GRADIENT, dp=1.2, minDist=17,
+        param1=50, param2=25, minRadius=9, maxRadius=15
+    )
+    if circles is None:
+        return None
+
+    vis_hough = image.copy()
+    for (x, y, r) in np.round(circles[0, :]).astype("int"):
+        cv2.circle(vis_hough, (x, y), r, (0, 255, 0), 2)
+    # cv2.imshow("03a - HoughCircles Detection", cv2.resize(vis_hough, (600, 750)))
+    # cv2.waitKey(0)
+    return np.round(circles[0, :, :2]).astype("int")
+
+
+def detect_contours(image, gray):
+    """Method 2: adaptive threshold + circular contours. Returns bubble centers or None."""
+    print("Attempting Method 2: Threshold + Contours...")
+    thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY_INV, 51, 15)
+    # cv2.imshow("03b - Adaptive Threshold", cv2.resize(thresh, (600, 750)))
+    # cv2.waitKey(0)
+
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    vis_contours = image.copy()
+    bubble_centers = []
+    for c in contours:
+        area = cv2.contourArea(c)
+        perimeter = cv2.arcLength(c, True)
+        if 50 < area < 500 and perimeter > 0:
+            circularity = (4 * np.pi * area) / (perimeter * perimeter)
+            if 0.8 < circularity < 1.2:
+                M = cv2.moments(c)
+                cX = int(M["m10"] / M["m00"])
+                cY = int(M["m01"] / M["m00"])
+                bubble_centers.append((cX, cY))
+                cv2.drawContours(vis_contours, [c], -1, (0, 255, 0), 2)
+    # cv2.imshow("04b - Contour Detection", cv2.resize(vis_contours, (600, 750)))
+    # cv2.waitKey(0)
+    return np.array(bubble_centers) if bubble_centers else None
+
+
+BUBBLE_STRATEGIES = {
+    "hough": detect_hough,
+    "contours": detect_contours,
+}
+
+
+def looks_like_bubble_grid(centers):
     """
-    The ultimate pipeline with hybrid detection for both circles and corners.
+    True if the largest grid among the centers is a complete sheet once stray
+    marks are dropped. On the sample sheets this leaves 387-400 bubbles for
+    Hough and 376-400 for contours when they see the whole sheet, and at most
+    241 when they miss part of it, e.g. contours on a dim or low contrast photo.
     """
-    image = cv2.imread(image_path)
-    if image is None: return None
-    
+    grids = find_grids(centers)
+    return bool(grids) and is_complete_grid(drop_strays(grids[0]))
+
+
+def detect_bubbles(image, gray, record=True):
+    """
+    Runs the bubble detection chain, starting with the strategy that won most
+    often on recent sheets. A result only counts when it has more than
+    MIN_CIRCLES_THRESHOLD bubbles, otherwise the rest of the chain is tried.
+    record=False runs the default chain without updating the statistics.
+    """
+    def attempt(name):
+        centers = BUBBLE_STRATEGIES[name](image, gray)
+        if centers is not None and len(centers) > MIN_CIRCLES_THRESHOLD:
+            print(f"Success! Found {len(centers)} bubbles with {name}.")
+            return centers
+        print(f"Method {name} failed to find enough circles.")
+        return None
+
+    return run_chain("bubbles", BUBBLE_STRATEGIES, attempt, looks_like_bubble_grid, record)
+
+
+# === CORNER DETECTION STRATEGIES ===
+def corners_line_fit(centers):
+    """Method A: line fitting on the outer rows/columns (best for straight images)."""
+    min_x, max_x = np.min(centers[:, 0]), np.max(centers[:, 0])
+    min_y, max_y = np.min(centers[:, 1]), np.max(centers[:, 1])
+    tolerance = 20
+
+    left_circles = centers[centers[:, 0] < min_x + tolerance]
+    right_circles = centers[centers[:, 0] > max_x - tolerance]
+    top_circles = centers[centers[:, 1] < min_y + tolerance]
+    bottom_circles = centers[centers[:, 1] > max_y - tolerance]
+
+    left_line = cv2.fitLine(left_circles, cv2.DIST_L2, 0, 0.01, 0.01)
+    right_line = cv2.fitLine(right_circles, cv2.DIST_L2, 0, 0.01, 0.01)
+    top_line = cv2.fitLine(top_circles, cv2.DIST_L2, 0, 0.01, 0.01)
+    bottom_line = cv2.fitLine(bottom_circles, cv2.DIST_L2, 0, 0.01, 0.01)
+
+    tl = find_intersection(top_line, left_line)
+    tr = find_intersection(top_line, right_line)
+    bl = find_intersection(bottom_line, left_line)
+    br = find_intersection(bottom_line, right_line)
+
+    if not all([tl, tr, bl, br]): raise Exception("Line fitting failed to find all corners")
+    return tl, tr, bl, br
+
+
+def corners_tilt_robust(centers):
+    """Method B: extreme points along the diagonals (best for skewed images)."""
+    s = centers.sum(axis=1)
+    diff = centers[:, 0] - centers[:, 1]
+
+    tl = tuple(centers[np.argmin(s)])
+    br = tuple(centers[np.argmax(s)])
+    tr = tuple(centers[np.argmax(diff)])
+    bl = tuple(centers[np.argmin(diff)])
+    return tl, tr, bl, br
+
+
+CORNER_STRATEGIES = {
+    "line_fit": corners_line_fit,
+    "tilt_robust": corners_tilt_robust,
+}
+
+
+def corners_fit_bubbles(centers, corners):
+    """True if the corner quad is convex, no bubble lies more than
+    MAX_CORNER_OVERHANG outside it and no corner more than that outside the
+    bubbles' bounding box."""
+    tl, tr, bl, br = corners
+    quad = np.array([tl, tr, br, bl], dtype=np.float32).reshape(-1, 1, 2)
+    if not cv2.isContourConvex(quad.astype(np.int32)):
+        return False
+    limit = MAX_CORNER_OVERHANG * bubble_spacing(centers)
+    points = quad.reshape(-1, 2)
+    low, high = centers.min(axis=0), centers.max(axis=0)
+    if np.any(points < low - limit) or np.any(points > high + limit):
+        return False
+    overhang = max(-cv2.pointPolygonTest(quad, (float(x), float(y)), True) for x, y in centers)
+    return overhang <= limit
+
+
+def find_corners(centers):
+    """
+    Runs the corner detection chain, recent winner first. Corners that do not
+    fit the bubbles count as a failure of the method.
+    Returns (tl, tr, bl, br) or None.
+    """
+    def attempt(name):
+        print(f"Attempting Corner Detection Method: {name}...")
+        try:
+            corners = CORNER_STRATEGIES[name](centers)
+        except Exception as e:
+            print(f"Corner method {name} failed ({e}).")
+            return None
+        if not corners_fit_bubbles(centers, corners):
+            print(f"Corner method {name} failed (corners do not fit the bubbles).")
+            return None
+        print(f"Corner method {name} successful.")
+        return corners
+
+    # attempt() already checks every result
+    return run_chain("corners", CORNER_STRATEGIES, attempt, lambda corners: True)
+
+
+def prepare_image(image, height=1000):
+    """Resizes to height (1000px by default) for detection. Returns (orig, resized, gray, ratio)."""
     orig = image.copy()
-    ratio = image.shape[0] / 1000.0
-    image = cv2.resize(image, (int(image.shape[1] / ratio), 1000))
+    ratio = image.shape[0] / float(height)
+    image = cv2.resize(image, (int(image.shape[1] / ratio), height))
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
+
     # cv2.imshow("01 - Resized Image", cv2.resize(image, (600, 750)))
     # cv2.waitKey(0)
     # cv2.imshow("02 - Grayscale", cv2.resize(gray, (600, 750)))
     # cv2.waitKey(0)
-    
-    centers = None
-    MIN_CIRCLES_THRESHOLD = 50
+    return orig, image, gray, ratio
 
-    # === HYBRID BUBBLE DETECTION ===
-    print("Attempting Method 1: HoughCircles...")
-    circles = cv2.HoughCircles(
-        gray, cv2.HOUGH_GRADIENT, dp=1.2, minDist=17,
-        param1=50, param2=25, minRadius=9, maxRadius=15
-    )
-
-    if circles is not None and len(circles[0]) > MIN_CIRCLES_THRESHOLD:
-        print(f"Success! Found {len(circles[0])} circles with HoughCircles.")
-        centers = np.round(circles[0, :, :2]).astype("int")
-        
-        vis_hough = image.copy()
-        for (x, y, r) in np.round(circles[0, :]).astype("int"):
-            cv2.circle(vis_hough, (x, y), r, (0, 255, 0), 2)
-        # cv2.imshow("03a - HoughCircles Detection", cv2.resize(vis_hough, (600, 750)))
-        # cv2.waitKey(0)
-
-    else:
-        print("Method 1 failed. Falling back to robust method...")
-        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                       cv2.THRESH_BINARY_INV, 51, 15)
-        # cv2.imshow("03b - Adaptive Threshold", cv2.resize(thresh, (600, 750)))
-        # cv2.waitKey(0)
-        
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        vis_contours = image.copy()
-        bubble_centers = []
-        for c in contours:
-            area = cv2.contourArea(c)
-            perimeter = cv2.arcLength(c, True)
-            if 50 < area < 500 and perimeter > 0:
-                circularity = (4 * np.pi * area) / (perimeter * perimeter)
-                if 0.8 < circularity < 1.2:
-                    M = cv2.moments(c)
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    bubble_centers.append((cX, cY))
-                    cv2.drawContours(vis_contours, [c], -1, (0, 255, 0), 2)
-        
-        if len(bubble_centers) > MIN_CIRCLES_THRESHOLD:
-             print(f"Success! Found {len(bubble_centers)} bubbles with Contours.")
-             centers = np.array(bubble_centers)
-            #  cv2.imshow("04b - Contour Detection", cv2.resize(vis_contours, (600, 750)))
-            #  cv2.waitKey(0)
-
-    if centers is None:
-        print("Both methods failed to find enough circles.")
-        return None
 
+def find_sheet_clusters(image, centers):
+    """
+    Removes noise with DBSCAN and returns the largest cluster of bubble
+    centers as the main grid. If nothing clusters, all centers are kept.
+    """
     # === CLUSTERING STEP TO REMOVE NOISE ===
     clustering = DBSCAN(eps=90, min_samples=5).fit(centers) # Adjusted eps to be more balanced
     labels = clustering.labels_
-    
+
     unique_labels, counts = np.unique(labels[labels != -1], return_counts=True)
-    if len(counts) > 0:
-        largest_cluster_label = unique_labels[np.argmax(counts)]
-        centers = centers[labels == largest_cluster_label]
-        print(f"Clustering complete. Isolated main grid with {len(centers)} bubbles.")
-
-        vis_cluster = image.copy()
-        for center in centers:
-            cv2.circle(vis_cluster, tuple(center), 10, (0, 255, 0), 2)
-        # cv2.imshow("04 - Clustered Bubbles (Noise Removed)", cv2.resize(vis_cluster, (600, 750)))
-        # cv2.waitKey(0)
-
-    # === START: HYBRID CORNER DETECTION ===
-    tl, tr, bl, br = None, None, None, None
-    try:
-        # METHOD A: Try line-fitting (best for straight images)
-        print("Attempting Corner Detection Method A: Line Fitting...")
-        min_x, max_x = np.min(centers[:, 0]), np.max(centers[:, 0])
-        min_y, max_y = np.min(centers[:, 1]), np.max(centers[:, 1])
-        tolerance = 20
-
-        left_circles = centers[centers[:, 0] < min_x + tolerance]
-        right_circles = centers[centers[:, 0] > max_x - tolerance]
-        top_circles = centers[centers[:, 1] < min_y + tolerance]
-        bottom_circles = centers[centers[:, 1] > max_y - tolerance]
-        
-        left_line = cv2.fitLine(left_circles, cv2.DIST_L2, 0, 0.01, 0.01)
-        right_line = cv2.fitLine(right_circles, cv2.DIST_L2, 0, 0.01, 0.01)
-        top_line = cv2.fitLine(top_circles, cv2.DIST_L2, 0, 0.01, 0.01)
-        bottom_line = cv2.fitLine(bottom_circles, cv2.DIST_L2, 0, 0.01, 0.01)
-
-        tl = find_intersection(top_line, left_line)
-        tr = find_intersection(top_line, right_line)
-        bl = find_intersection(bottom_line, left_line)
-        br = find_intersection(bottom_line, right_line)
-        
-        if not all([tl, tr, bl, br]): raise Exception("Line fitting failed to find all corners")
-        print("Method A (Line Fitting) successful.")
-
-    except Exception as e:
-        # METHOD B: Fallback to tilt-robust method (best for skewed images)
-        print(f"Method A failed ({e}), falling back to Method B (Tilt-Robust)...")
-        s = centers.sum(axis=1)
-        diff = centers[:, 0] - centers[:, 1]
-        
-        tl = tuple(centers[np.argmin(s)])
-        br = tuple(centers[np.argmax(s)])
-        tr = tuple(centers[np.argmax(diff)])
-        bl = tuple(centers[np.argmin(diff)])
-        print("Method B (Tilt-Robust) successful.")
-    # === END: HYBRID CORNER DETECTION ===
-    
+    if len(counts) == 0:
+        return centers
+
+    centers = centers[labels == unique_labels[np.argmax(counts)]]
+    print(f"Clustering complete. Isolated main grid with {len(centers)} bubbles.")
+
+    vis_cluster = image.copy()
+    for center in centers:
+        cv2.circle(vis_cluster, tuple(center), 10, (0, 255, 0), 2)
+    # cv2.imshow("04 - Clustered Bubbles (Noise Removed)", cv2.resize(vis_cluster, (600, 750)))
+    # cv2.waitKey(0)
+    return centers
+
+
+def bubble_spacing(centers):
+    """Median distance from a bubble to its nearest neighbour."""
+    distances, _ = NearestNeighbors(n_neighbors=2).fit(centers).kneighbors(centers)
+    return float(np.median(distances[:, 1]))
+
+
+def find_grids(centers):
+    """
+    Groups bubble centers into answer grids, largest first. Bubbles less
+    than SHEET_LINK_SPACINGS bubble spacings apart share a grid, which keeps
+    the subject columns of a sheet together at any image scale.
+    """
+    if len(centers) < 2:
+        return []
+    eps = SHEET_LINK_SPACINGS * bubble_spacing(centers)
+    labels = DBSCAN(eps=eps, min_samples=5).fit(centers).labels_
+    unique_labels, counts = np.unique(labels[labels != -1], return_counts=True)
+    return [centers[labels == unique_labels[i]] for i in np.argsort(-counts, kind="stable")]
+
+
+def drop_strays(grid):
+    """
+    Removes centers without both a row and a column neighbour within 1.5
+    bubble spacings. Every bubble has both; a stray mark or a round header
+    letter linked to the grid would drag its corners out.
+    """
+    if len(grid) < 3:
+        return grid
+    neighbours = NearestNeighbors(radius=1.5 * bubble_spacing(grid)).fit(grid).radius_neighbors(
+        grid, return_distance=False)
+    keep = []
+    for point, indices in zip(grid, neighbours):
+        offsets = np.abs(grid[indices] - point)
+        # Diagonal neighbours count for neither
+        keep.append(np.any(offsets[:, 1] < offsets[:, 0] / 2) and np.any(offsets[:, 0] < offsets[:, 1] / 2))
+    return grid[np.array(keep)]
+
+
+def is_complete_grid(grid):
+    return abs(len(grid) - EXPECTED_BUBBLES) <= SHEET_BUBBLE_TOLERANCE * EXPECTED_BUBBLES
+
+
+def warp_cluster(orig, image, centers, ratio):
+    """
+    Finds the corners of one bubble grid and warps it top-down.
+    Returns (warped, bbox) with bbox = [x, y, w, h] in original image pixels, or None.
+    """
+    # === HYBRID CORNER DETECTION ===
+    corners = find_corners(centers)
+    if corners is None:
+        print("All corner detection methods failed.")
+        return None
+    tl, tr, bl, br = corners
+
     vis_lines = image.copy()
     cv2.line(vis_lines, tl, tr, (0, 0, 255), 2)
     cv2.line(vis_lines, tr, br, (0, 0, 255), 2)
@@ -150,10 +405,10 @@ def warp_image(image_path):
         cv2.circle(vis_lines, p, 10, (0, 255, 255), -1)
     # cv2.imshow("05 - Final Corners Detected", cv2.resize(vis_lines, (600, 750)))
     # cv2.waitKey(0)
-    
+
     corner_points = np.array([tl, tr, br, bl], dtype="float32")
     corner_points *= ratio
-    
+
     # === PERSPECTIVE TRANSFORM WITH MARGIN ===
     (tl_orig, tr_orig, br_orig, bl_orig) = corner_points
     widthA = np.sqrt(((br_orig[0] - bl_orig[0]) ** 2) + ((br_orig[1] - bl_orig[1]) ** 2))
@@ -162,10 +417,16 @@ def warp_image(image_path):
     heightA = np.sqrt(((tr_orig[0] - br_orig[0]) ** 2) + ((tr_orig[1] - br_orig[1]) ** 2))
     heightB = np.sqrt(((tl_orig[0] - bl_orig[0]) ** 2) + ((tl_orig[1] - bl_orig[1]) ** 2))
     maxHeight = max(int(heightA), int(heightB))
-    
+
+    # Corners far off the grid would make a huge (or empty) warp
+    _, _, grid_w, grid_h = cv2.boundingRect(np.round(centers * ratio).astype(np.int32))
+    if not (grid_w / 2 <= maxWidth <= grid_w * 2 and grid_h / 2 <= maxHeight <= grid_h * 2):
+        print(f"Warp of {maxWidth}x{maxHeight} does not match the {grid_w}x{grid_h} bubble grid.")
+        return None
+
     padding_x = int(maxWidth * 0.02)
     padding_y = int(maxHeight * 0.02)
-    
+
     dst = np.array([
         [padding_x, padding_y],
         [maxWidth + padding_x - 1, padding_y],
@@ -177,7 +438,189 @@ def warp_image(image_path):
 
     M = cv2.getPerspectiveTransform(corner_points, dst)
     warped = cv2.warpPerspective(orig, M, (finalWidth, finalHeight))
-    
+
+
+    bbox = [int(v) for v in cv2.boundingRect(np.round(corner_points).astype(np.int32))]
+    return warped, bbox
+
+
+def rectify_sheet(image):
+    """
+    The ultimate pipeline with hybrid detection for both circles and corners.
+    Takes a decoded BGR image and returns the top-down warped sheet, or None.
+    Only the largest sheet in the frame is used, see rectify_sheets.
+    """
+    orig, image, gray, ratio = prepare_image(image)
+
+    # === HYBRID BUBBLE DETECTION ===
+    centers = detect_bubbles(image, gray)
+    if centers is None:
+        print("All methods failed to find enough circles.")
+        return None
+
+    centers = find_sheet_clusters(image, centers)
+    result = warp_cluster(orig, image, centers, ratio)
+    return result[0] if result is not None else None
+
+
+def warp_grid(orig, image, grid, ratio):
+    """
+    warp_cluster for a grid of rectify_sheets.
+    Returns (warped, bbox, bubbles, reason); see rectify_grid.
+    """
+    try:
+        result = warp_cluster(orig, image, grid, ratio)
+    except cv2.error as e:
+        print(f"Warping the grid failed ({e}).")
+        result = None
+    if result is None:
+        return None, None, len(grid), "no corners fit the bubble grid"
+    return result[0], result[1], len(grid), None
+
+
+def rectify_region(region, height=1000):
+    """
+    Detects one sheet in a crop of the original image, scaled to height for
+    detection. Returns (warped, bbox, bubbles, reason); see rectify_grid.
+    """
+    orig, image, gray, ratio = prepare_image(region, height)
+    centers = detect_bubbles(image, gray, record=False)
+    grids = find_grids(centers) if centers is not None else []
+    if not grids:
+        return None, None, 0, "no bubbles found"
+    grid = drop_strays(grids[0])
+    if not is_complete_grid(grid):
+        return None, None, len(grid), f"expected about {EXPECTED_BUBBLES} bubbles"
+    return warp_grid(orig, image, grid, ratio)
+
+
+def rectify_grid(orig, image, grid, ratio):
+    """
+    Reads one bubble grid found in image (orig scaled down by ratio) as a
+    sheet. A grid without about EXPECTED_BUBBLES bubbles, e.g. because it is
+    too small for the detectors at this scale, is cropped with a margin and
+    detected again at full resolution, scaled so that its bubbles are as far
+    apart as on a single sheet photo.
+    Returns (warped, bbox, bubbles, reason): bbox is [x, y, w, h] in orig;
+    warped and bbox are None and reason says why if the grid was not read.
+    """
+    sheet_grid = drop_strays(grid)
+    if is_complete_grid(sheet_grid):
+        return warp_grid(orig, image, sheet_grid, ratio)
+
+    print(f"Grid with {len(grid)} bubbles is incomplete, detecting again at full resolution.")
+    x, y, w, h = cv2.boundingRect(grid.astype(np.int32))
+    mx, my = CANDIDATE_MARGIN * w, CANDIDATE_MARGIN * h
+    x0, y0 = max(int((x - mx) * ratio), 0), max(int((y - my) * ratio), 0)
+    x1 = min(int((x + w + mx) * ratio), orig.shape[1])
+    y1 = min(int((y + h + my) * ratio), orig.shape[0])
+    height = int(round((y1 - y0) * SHEET_SPACING / (bubble_spacing(grid) * ratio)))
+    warped, bbox, bubbles, reason = rectify_region(orig[y0:y1, x0:x1], height)
+    if bbox is not None:
+        bbox = [bbox[0] + x0, bbox[1] + y0, bbox[2], bbox[3]]
+    return warped, bbox, bubbles, reason
+
+
+def box_center_in(box, boxes):
+    center_x, center_y = box[0] + box[2] / 2.0, box[1] + box[3] / 2.0
+    return any(bx <= center_x <= bx + bw and by <= center_y <= by + bh for bx, by, bw, bh in boxes)
+
+
+def boxes_overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def has_room_for_sheet(shape, boxes, size):
+    """True if a box of size (w, h) fits in a frame of shape without overlapping boxes."""
+    scale = min(200.0 / max(shape[:2]), 1.0)
+    occupied = np.zeros((int(shape[0] * scale) + 1, int(shape[1] * scale) + 1), dtype=np.uint8)
+    for x, y, w, h in boxes:
+        occupied[int(y * scale):int((y + h) * scale) + 1, int(x * scale):int((x + w) * scale) + 1] = 1
+    kw, kh = max(int(size[0] * scale), 1), max(int(size[1] * scale), 1)
+    if kh > occupied.shape[0] or kw > occupied.shape[1]:
+        return False
+    s = cv2.integral(occupied)
+    window = s[kh:, kw:] - s[:-kh, kw:] - s[kh:, :-kw] + s[:-kh, :-kw]
+    return bool(np.any(window == 0))
+
+
+def detect_sheets(orig, height, sheets):
+    """
+    One detection pass of rectify_sheets at the given detection height.
+    Grids inside one of the sheets already found are skipped. A frame of
+    several sheets is not a typical sheet of the batch, so the detection
+    statistics are neither used nor updated.
+    Returns (found, dropped) as in rectify_sheets.
+    """
+    _, image, gray, ratio = prepare_image(orig, height)
+    centers = detect_bubbles(image, gray, record=False)
+    if centers is None:
+        print(f"No bubbles found at {height}px.")
+        return [], []
+
+    found, dropped = [], []
+    for grid in find_grids(centers):
+        region = [int(v * ratio) for v in cv2.boundingRect(grid.astype(np.int32))]
+        # Part of a sheet that was already read
+        if box_center_in(region, [s["bbox"] for s in sheets + found]):
+            continue
+        if len(grid) <= MIN_CIRCLES_THRESHOLD:
+            dropped.append({"bbox": region, "bubbles": len(grid), "reason": "too few bubbles"})
+            continue
+
+        warped, bbox, bubbles, reason = rectify_grid(orig, image, grid, ratio)
+        if warped is None:
+            dropped.append({"bbox": region, "bubbles": bubbles, "reason": reason})
+            continue
+        found.append({"warped": warped, "bbox": bbox})
+    return found, dropped
+
+
+def rectify_sheets(image):
+    """
+    Like rectify_sheet, but warps every sheet in the frame.
+    Returns (sheets, dropped): sheets is a list of {"warped", "bbox"} in
+    reading order (top to bottom, then left to right), dropped a list of
+    {"bbox", "bubbles", "reason"} for bubble grids that were not read as a
+    sheet. Boxes are [x, y, w, h] in the input image.
+
+    The frame is searched at the detection heights of SHEET_PASS_HEIGHTS
+    until every grid was read and there is no room left for another sheet.
+    A grid is reported in dropped by the finest pass that saw it.
+    """
+    orig = image
+    sheets, dropped = [], []
+    for index, height in enumerate(SHEET_PASS_HEIGHTS):
+        if index > 0 and sheets and not dropped:
+            smallest = min((s["bbox"] for s in sheets), key=lambda box: box[2] * box[3])
+            if not has_room_for_sheet(orig.shape, [s["bbox"] for s in sheets], smallest[2:]):
+                break
+        found, pass_dropped = detect_sheets(orig, height, sheets)
+        seen = [s["bbox"] for s in found] + [d["bbox"] for d in pass_dropped]
+        dropped = [d for d in dropped if not any(boxes_overlap(d["bbox"], box) for box in seen)]
+        sheets += found
+        dropped += pass_dropped
+
+    for d in dropped:
+        print(f"Dropped bubble grid at {d['bbox']} with {d['bubbles']} bubbles: {d['reason']}.")
+
+    # Sheets whose centers are within half a sheet height share a row
+    if sheets:
+        row_height = max(np.median([s["bbox"][3] for s in sheets]) / 2.0, 1.0)
+        sheets.sort(key=lambda s: (int((s["bbox"][1] + s["bbox"][3] / 2.0) // row_height),
+                                   s["bbox"][0]))
+    return sheets, dropped
+
+
+# Pass in the image to crop it
+def warp_image(image_path):
+    """Warps the sheet at image_path and saves it as debug_warped.jpg."""
+    image = cv2.imread(image_path)
+    if image is None: return None
+
+    warped = rectify_sheet(image)
+    if warped is None: return None
+
     # Save image as warped
     writeImg = "debug_warped.jpg"
     cv2.imwrite(writeImg, warped)
@@ -193,5 +636,5 @@ if __name__ == "__main__":
 
     print(f"Saved warped image as {final_sheet_name}")
 
-    
-    cv2.destroyAllWindows()
\ No newline at end of file
+
+    cv2.destroyAllWindows()
@@ -0,0 +1,191 @@
+"""
+Parameter tuning harness for the answer extraction step.
+
+Detection and warping are the slow part of the pipeline and do not depend on
+the extraction parameters, so every corpus image is rectified once and the
+canonical sheets are cached in a single memory-mapped .npy file. Each trial
+then only re-runs s2.read_answers on the cached sheets.
+
+Usage:
+    python tune.py uploads/omr ground_truth.json
+    python tune.py uploads/omr ground_truth.json --grid grid.json --csv results.csv
+
+ground_truth.json maps image file names to the 5 x 20 answer lists returned
+by process_with_fallback ("None" for blank questions). grid.json maps
+read_answers keyword arguments to lists of values to try, e.g.
+    {"fill_threshold": [0.5, 0.6], "grid_weights": [{"q_row_weight": 1.9}]}
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from s2 import read_answers, FILLED_BUBBLE_THRESHOLD, ADAPTIVE_THRESH_BLOCK_SIZE, ADAPTIVE_THRESH_C
+from tilt import rectify_sheet
+
+CACHE_DIR = os.path.join("uploads", "tuning_cache")
+CANONICAL_HEIGHT = 1000
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+DEFAULT_GRID = {
+    "fill_threshold": sorted({0.5, FILLED_BUBBLE_THRESHOLD, 0.7}),
+    "block_size": sorted({31, ADAPTIVE_THRESH_BLOCK_SIZE, 71}),
+    "thresh_c": sorted({10, ADAPTIVE_THRESH_C, 20}),
+}
+
+
+# -------------------------
+# Sheet cache
+# -------------------------
+def corpus_files(corpus_dir, names):
+    return [n for n in sorted(os.listdir(corpus_dir))
+            if n.lower().endswith(IMAGE_EXTENSIONS) and n in names]
+
+
+def build_cache(corpus_dir, names, cache_dir=CACHE_DIR):
+    """
+    Rectifies every corpus image and stores the sheets, resized to
+    CANONICAL_HEIGHT with their aspect ratio kept, in cache_dir/sheets.npy.
+    Rows are padded to the widest sheet; the real width of each row is kept
+    in sheets.json. The cache is reused as long as the file list and
+    modification times are unchanged. Returns (array_path, names, widths).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    array_path = os.path.join(cache_dir, "sheets.npy")
+    index_path = os.path.join(cache_dir, "sheets.json")
+
+    sources = {n: os.path.getmtime(os.path.join(corpus_dir, n)) for n in names}
+    if os.path.isfile(array_path) and os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["sources"] == sources and "widths" in index:
+            print(f"Using cached sheets from {array_path}")
+            return array_path, index["names"], index["widths"]
+
+    sheets, cached_names = [], []
+    for name in names:
+        image = cv2.imread(os.path.join(corpus_dir, name))
+        warped = rectify_sheet(image) if image is not None else None
+        if warped is None:
+            print(f"Skipping {name}: could not rectify.")
+            continue
+        ratio = CANONICAL_HEIGHT / float(warped.shape[0])
+        sheets.append(cv2.resize(warped, (int(warped.shape[1] * ratio), CANONICAL_HEIGHT),
+                                 interpolation=cv2.INTER_AREA))
+        cached_names.append(name)
+    if not sheets:
+        raise SystemExit("No sheet could be rectified, nothing to tune.")
+
+    # Resizing to a shared width would distort the grid, so narrower sheets are
+    # padded instead and sliced back to their own width before reading
+    widths = [s.shape[1] for s in sheets]
+    cache = np.lib.format.open_memmap(array_path, mode="w+", dtype=np.uint8,
+                                      shape=(len(sheets), CANONICAL_HEIGHT, max(widths), 3))
+    for i, sheet in enumerate(sheets):
+        cache[i, :, :widths[i]] = sheet
+        cache[i, :, widths[i]:] = 0
+    cache.flush()
+    del cache
+
+    with open(index_path, "w") as f:
+        json.dump({"names": cached_names, "sources": sources, "widths": widths}, f)
+    print(f"Cached {len(cached_names)} sheets in {array_path}")
+    return array_path, cached_names, widths
+
+
+# -------------------------
+# Trials (run in the process pool)
+# -------------------------
+worker_sheets = None
+worker_widths = None
+worker_truth = None
+
+
+def init_worker(array_path, widths, truth):
+    global worker_sheets, worker_widths, worker_truth
+    # Parallelism comes from the pool; OpenCV's own threads would only compete with it
+    cv2.setNumThreads(1)
+    worker_sheets = np.load(array_path, mmap_mode="r")
+    worker_widths = widths
+    worker_truth = truth
+
+
+def run_trial(params):
+    correct = total = 0
+    # CPU time, so trials running side by side don't inflate each other's timings
+    start = time.process_time()
+    for sheet, width, expected in zip(worker_sheets, worker_widths, worker_truth):
+        # read_answers prints its progress, which would dominate a trial
+        with contextlib.redirect_stdout(io.StringIO()):
+            answers, _ = read_answers(np.ascontiguousarray(sheet[:, :width]), **params)
+        for subj_idx, subj_expected in enumerate(expected):
+            for q_idx, ans in enumerate(subj_expected):
+                total += 1
+                if answers is not None and answers[subj_idx][q_idx] == ans:
+                    correct += 1
+    elapsed = time.process_time() - start
+    return {
+        "params": params,
+        "accuracy": correct / total if total else 0.0,
+        "ms_per_sheet": 1000.0 * elapsed / max(len(worker_truth), 1),
+    }
+
+
+def expand_grid(grid):
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def sweep(array_path, widths, truth, grid, workers=None):
+    trials = expand_grid(grid)
+    print(f"Running {len(trials)} trials on {len(truth)} sheets...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(array_path, widths, truth)) as pool:
+        results = list(pool.map(run_trial, trials))
+    return sorted(results, key=lambda r: (-r["accuracy"], r["ms_per_sheet"]))
+
+
+# -------------------------
+# Main
+# -------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Sweep answer extraction parameters against ground truth.")
+    parser.add_argument("corpus_dir", help="Folder with the OMR sheet images")
+    parser.add_argument("ground_truth", help="JSON file mapping image names to their answers")
+    parser.add_argument("--grid", help="JSON file with the parameter grid (default: built-in grid)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--csv", help="Also write all trial results to this CSV file")
+    parser.add_argument("--top", type=int, default=10, help="Number of trials to print")
+    args = parser.parse_args()
+
+    with open(args.ground_truth) as f:
+        ground_truth = json.load(f)
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+
+    array_path, names, widths = build_cache(args.corpus_dir, corpus_files(args.corpus_dir, ground_truth))
+    truth = [ground_truth[n] for n in names]
+    results = sweep(array_path, widths, truth, grid, args.workers)
+
+    print(f"\n{'Accuracy':>9} {'ms/sheet':>9}  Parameters")
+    for r in results[:args.top]:
+        print(f"{r['accuracy']:9.4f} {r['ms_per_sheet']:9.1f}  {json.dumps(r['params'])}")
+
+    if args.csv:
+        import pandas as pd
+        rows = [{**r["params"], "accuracy": r["accuracy"], "ms_per_sheet": r["ms_per_sheet"]} for r in results]
+        pd.DataFrame(rows).to_csv(args.csv, index=False)
+        print(f"Saved all results to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()